@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark of the fastphylo xml distance matrix reader.
+
+A fastphylo xml file with N genes is generated (default 5000), then read
+with the previous method (whole file read in a string, then parsed into a
+DOM tree) and with the streaming reader of ClusterUtils. Each reader is run
+in its own process, so that the peak memory (maxrss) can be reported.
+
+usage : python benchmarks/phyloxml_reader.py [N] [xmlfile]
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from StringIO import StringIO
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from profileNJ.TreeLib import ClusterUtils
+
+
+def writeFastPhyloXml(filename, size, seed=12345):
+    """Write a random fastphylo xml distance matrix of the given size"""
+    rand = np.random.RandomState(seed)
+    with open(filename, 'w') as outfile:
+        outfile.write('<?xml version="1.0"?>\n<root>\n')
+        outfile.write('<run dim="%d">\n<identities>\n' % size)
+        for i in xrange(size):
+            outfile.write('<identity name="gene%d"/>\n' % i)
+        outfile.write('</identities>\n<dms>\n<dm>\n')
+        for i in xrange(size):
+            row = rand.rand(i + 1)
+            row[-1] = 0
+            outfile.write('<row>%s</row>\n' % "".join(
+                '<entry>%.6f</entry>' % val for val in row))
+        outfile.write('</dm>\n</dms>\n</run>\n</root>\n')
+
+
+def domReader(filename):
+    """Previous reader : the whole file is loaded, then parsed in a DOM tree"""
+    etree = ClusterUtils.etree
+    with open(filename, 'rU') as infile:
+        content = infile.read()
+    xml = etree.parse(StringIO(content))
+    run = xml.find('.//run')
+    dimension = int(run.attrib['dim'])
+    node_order = [i.attrib['name'] for i in run.find('identities').iter('identity')]
+    dm = run.find('dms').find('dm')
+    distance_mat = np.zeros(shape=(dimension, dimension), dtype=np.float)
+    for i, node in enumerate(dm.iter('row')):
+        for j, entry in enumerate(node.iter('entry')):
+            val = float(entry.text)
+            distance_mat[i, j] = val
+            distance_mat[j, i] = val
+    return distance_mat, node_order
+
+
+def streamReader(filename):
+    """Current reader"""
+    return ClusterUtils.distMatProcessor(filename)
+
+
+def run(reader, filename, queue):
+    start = time.time()
+    matrix, node_order = reader(filename)
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, maxrss, matrix.sum(), len(node_order)))
+
+
+def benchmark(reader, filename):
+    queue = Queue()
+    proc = Process(target=run, args=(reader, filename, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    if len(sys.argv) > 2:
+        filename, remove = sys.argv[2], False
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+        remove = True
+
+    try:
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            writeFastPhyloXml(filename, size)
+        print("%s : %.1f MB" % (filename, os.path.getsize(filename) / 1e6))
+        checks = set()
+        for name, reader in (('dom', domReader), ('iterparse', streamReader)):
+            elapsed, maxrss, total, nnodes = benchmark(reader, filename)
+            checks.add((round(total, 3), nnodes))
+            print("%-10s %8.2f s %10.1f MB maxrss" %
+                  (name, elapsed, maxrss / 1024.))
+        if len(checks) != 1:
+            sys.exit("readers disagree : %s" % checks)
+    finally:
+        if remove:
+            os.remove(filename)
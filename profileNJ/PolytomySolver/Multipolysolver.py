@@ -4,6 +4,8 @@ Date: 05/2014
 MultiPolysolver is a python module for polytomy solving
 """
 
+import hashlib
+import itertools
 import numpy
 import random
 from pprint import pprint
@@ -14,100 +16,38 @@ from ..TreeLib import *
 Gene matrix are represented by a numpy array
 """
 
-DUP = 'd'
-LOST = 'l'
-SPEC = 's'
+# flags of the path table, a cell can have several of them, the paths are
+# explored in this order
+SPEC = 1
+LOST = 2
+DUP = 4
+PATH_FLAGS = (SPEC, LOST, DUP)
 PARTIAL_RESOLUTION_ITERATOR = 1
 numpy.set_printoptions(threshold='nan', precision=10)
 
 
 @memorize
-def polySolver(genetree, specietree, gene_matrix, node_order, limit=-1, cluster_method='upgma', verbose=False, mode="solve"):
+def polySolver(genetree, specietree, gene_matrix, node_order, limit=-1, cluster_method='upgma', verbose=False, mode="solve", costs=None):
     """This assume we that we are using the correct specietree for this genetree
-    the specie tree root is the latest common ancestor of all the specie in genetree"""
+    the specie tree root is the latest common ancestor of all the specie in genetree
+    The dup/loss costs are read from the CostModel costs (params.default when it's None),
+    its key should be part of the hash used by memorize"""
     count = TreeUtils.getSpecieCount(
         genetree)  # number of specie in the genetree
     max_y = max(count.values()) + 1
     # assigning a correspondance between each row and a node
     # the assignment is done in level order
     polytomy_specie_set, row_node_corr = findMaxX(genetree, specietree)
-    max_x = len(polytomy_specie_set)
-    # cost cost_table to fill
-    cost_table = numpy.zeros((max_x, max_y), dtype=float)
-    # table to save the possible path
-    path_table = numpy.ndarray((max_x, max_y), dtype='object')
-
-    # fill the cost_table and the path_table
-
-    for n in xrange(0, max_x):
-        node = row_node_corr[n]
-        zeropos = count[node.name] - 1
-        # We have zeropos when the number of node from a specie is the same as the column number
-        # Fill the table, using the next/previous case cost
-        # The node is a leaf, just fill with dupcost and losscost
-        if(node.is_leaf()):
-            # find the column with a cost of zero (zeropos) and fill the table
-            # according to this position
-            # by default, all the position in the table are 0
-            i = zeropos - 1
-            while(i >= 0):
-                cost_table[n, i] = cost_table[n, i + 1] + params.getdup(node)
-                path_table[n, i] = DUP
-                i -= 1
-            i = zeropos + 1
-            while(i < max_y):
-                cost_table[n, i] = cost_table[n, i - 1] + params.getloss(node)
-                path_table[n, i] = LOST
-                i += 1
-            # We should take into account the special case here
-        # Here we have an internal node (not a leaf in the genetree)
-        else:
-            l_child_id = [key for key, value in row_node_corr.iteritems() if(
-                value == node.get_child_at(0))][0]
-            r_child_id = [key for key, value in row_node_corr.iteritems() if(
-                value == node.get_child_at(1))][0]
-            # Fill the table using only the speciation cost(sum of the
-            # children's cost of this node)
-            for k in xrange(0, max_y):
-                if(k > zeropos):
-                    cost_table[n, k] = cost_table[
-                        l_child_id, k - zeropos - 1] + cost_table[r_child_id, k - zeropos - 1]
-                    path_table[n, k] = SPEC
-                else:
-                    cost_table[n, k] = numpy.inf
-
-            # Find all the min score position and try to minimize the score of its
-            # neighborhood by lost/dup cost
-            minpos = numpy.where(cost_table[n, :] == cost_table[n, :].min())
-            for pos in minpos[0]:
-                i = pos - 1
-                while(i >= 0):
-                    if(cost_table[n, i] == cost_table[n, i + 1] + params.getdup(node)):
-                        if DUP not in path_table[n, i]:
-                            path_table[n, i] += DUP
-                    elif (cost_table[n, i] > cost_table[n, i + 1] + params.getdup(node)):
-                        cost_table[n, i] = min(
-                            cost_table[n, i + 1] + params.getdup(node), cost_table[n, i])
-                        path_table[n, i] = DUP
-                    i -= 1
-
-                i = pos + 1
-                while(i < max_y):
-                    if(cost_table[n, i] == cost_table[n, i - 1] + params.getloss(node)):
-                        if LOST not in path_table[n, i]:
-                            path_table[n, i] += LOST
-                    elif (cost_table[n, i] > cost_table[n, i - 1] + params.getloss(node)):
-                        cost_table[n, i] = min(
-                            cost_table[n, i - 1] + params.getloss(node), cost_table[n, i])
-                        path_table[n, i] = LOST
-                    i += 1
+    cost_table, path_table = fillCostTable(
+        specietree, row_node_corr, count, max_y, costs)
 
     # find the shape of the cost_table
     xsize, ysize = cost_table.shape
     if(mode is not "solve"):
         return cost_table, row_node_corr
     else:
-        paths = findPathFromTable(
+        # the paths are built one by one, until limit
+        paths = iterPathFromTable(
             path_table, row_node_corr, count, xsize - 1, 0)
         solution = []
 
@@ -126,122 +66,186 @@ def polySolver(genetree, specietree, gene_matrix, node_order, limit=-1, cluster_
             print()
             print("Specie Tree:\n")
             print(specietree.get_ascii())
+            paths = list(paths)
             print("\nNumber of Tree found : ", len(paths), "\n")
             print("List of possible path: ")
             for path in paths:
                 print(path)
             print()
 
-        i = 1
+        if(limit > 0):
+            paths = itertools.islice(paths, limit)
         for path in paths:
-            if(limit > 0 and i > limit):
-                break
-            solution.append(constructFromPath(path, genetree, specietree, numpy.copy(gene_matrix), node_order[
+            solution.append(constructFromPath(path, genetree, specietree, gene_matrix.copy(), node_order[
                             :], verbose=verbose, method=cluster_method, cost=cost_table[xsize - 1, 0]))
-            i += 1
 
         return solution
 
 
-def findSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos):
-    """DEBUG, choose the path that privilegie speciation only"""
+def fillCostTable(specietree, row_node_corr, count, max_y, costs=None):
+    """Fill the cost table and the path table of a polytomy (see polySolver),
+    with the dup/loss costs of the CostModel costs"""
+    max_x = len(row_node_corr)
+    # dup and loss cost of the specie of each row, resolved once
+    spnodes, spdup, sploss = params.get_model(costs).compile_costs(specietree)
+    spid = dict((node, i) for i, node in enumerate(spnodes))
+    rows = [spid[row_node_corr[n]] for n in xrange(0, max_x)]
+    row_dup, row_loss = spdup[rows].tolist(), sploss[rows].tolist()
+    # cost cost_table to fill
+    cost_table = numpy.zeros((max_x, max_y), dtype=float)
+    # table to save the possible path, as flags (0 for no path)
+    path_table = numpy.zeros((max_x, max_y), dtype=numpy.uint8)
+    row_id = rowIds(row_node_corr)
+
+    # fill the cost_table and the path_table
 
-    chemin = []
-    if(row_node_corr[xpos].is_leaf() and (ypos < 0 or path_table[xpos, ypos] is None)):
-        case = row_node_corr[xpos].name + ':%i' % (ypos + 1)
-        chemin.append(case)
+    for n in xrange(0, max_x):
+        node = row_node_corr[n]
+        dupcost, losscost = row_dup[n], row_loss[n]
+        zeropos = count[node.name] - 1
+        # We have zeropos when the number of node from a specie is the same as the column number
+        # Fill the table, using the next/previous case cost
+        # The node is a leaf, just fill with dupcost and losscost
+        if(node.is_leaf()):
+            # find the column with a cost of zero (zeropos) and fill the table
+            # according to this position (dupcost on the left, losscost on the right)
+            if zeropos > 0:
+                cost_table[n, :zeropos] = numpy.cumsum(
+                    numpy.full(zeropos, dupcost))[::-1]
+                path_table[n, :zeropos] = DUP
+            cost_table[n, zeropos + 1:] = numpy.cumsum(
+                numpy.full(max_y - zeropos - 1, losscost))
+            path_table[n, zeropos + 1:] = LOST
+            # We should take into account the special case here
+        # Here we have an internal node (not a leaf in the genetree)
+        else:
+            l_child_id = row_id[node.get_child_at(0)]
+            r_child_id = row_id[node.get_child_at(1)]
+            # Fill the table using only the speciation cost(sum of the
+            # children's cost of this node)
+            width = max_y - zeropos - 1
+            cost_table[n, :zeropos + 1] = numpy.inf
+            cost_table[n, zeropos + 1:] = cost_table[l_child_id, :width] + \
+                cost_table[r_child_id, :width]
+            path_table[n, zeropos + 1:] = SPEC
+
+            # Find all the min score position and try to minimize the score of its
+            # neighborhood by dup cost (on the left) and lost cost (on the right)
+            row, flags = cost_table[n], path_table[n]
+            for pos in numpy.flatnonzero(row == row.min()):
+                sweepCostRow(row[pos::-1], flags[pos::-1], dupcost, DUP)
+                sweepCostRow(row[pos:], flags[pos:], losscost, LOST)
+    return cost_table, path_table
+
+
+def sweepCostRow(row, flags, cost, flag):
+    """Minimize each cost of row (a view of a row of the cost table) by the
+    cost of the previous cell plus cost, from the second cell to the end.
+    The cells reached from the previous one get flag, the other flags are
+    removed when their cost is decreased"""
+    # the cost is added one cell at a time, so that the sums are rounded
+    # the same way for costs that are not exact in binary
+    values = row.tolist()
+    for i in xrange(1, len(values)):
+        reached = values[i - 1] + cost
+        if values[i] == reached:
+            flags[i] |= flag
+        elif values[i] > reached:
+            values[i] = reached
+            flags[i] = flag
+    row[:] = values
+
+
+def findSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id=None):
+    """DEBUG, choose the path that privilegie speciation only"""
+    return list(iterSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id))
+
+
+def iterSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id=None):
+    """Generator version of findSpeciationPathFromTable, the paths are
+    yielded one by one, in the same order. row_id is the row of each
+    specie node (see rowIds), built once when it's not given"""
+    if row_id is None:
+        row_id = rowIds(row_node_corr)
+    case = row_node_corr[xpos].name + ':%i' % (ypos + 1)
+    if(row_node_corr[xpos].is_leaf() and (ypos < 0 or not path_table[xpos, ypos])):
+        yield case
     else:
         # each case can have multiple path
-        if 's' in path_table[xpos, ypos]:
-            # this is bad for perfomance
-            spec_pos_1 = [x for x in row_node_corr.keys() if row_node_corr[
-                xpos].get_child_at(0) == row_node_corr[x]][0]
-            spec_pos_2 = [x for x in row_node_corr.keys() if row_node_corr[
-                xpos].get_child_at(1) == row_node_corr[x]][0]
-            snode = row_node_corr[xpos].name
-            nb_node = count[snode]
-            spec_1 = findSpeciationPathFromTable(
-                path_table, row_node_corr, count, spec_pos_1, ypos - nb_node)
-            spec_2 = findSpeciationPathFromTable(
-                path_table, row_node_corr, count, spec_pos_2, ypos - nb_node)
+        if path_table[xpos, ypos] & SPEC:
+            spec_pos_1, spec_pos_2 = _childrenRows(row_node_corr, row_id, xpos)
+            nb_node = count[row_node_corr[xpos].name]
             # add all possible path from the children
-            chemin.extend([",".join([row_node_corr[xpos].name + ':%i' %
-                                     (ypos + 1), path1, path2]) for path1 in spec_1 for path2 in spec_2])
-
-        else:
-            c = path_table[xpos, ypos][0]
-            if c == 'd':
-                dup = findSpeciationPathFromTable(
-                    path_table, row_node_corr, count, xpos, ypos + 1)
-                # add possible path of the case that lead to this duplication
-                chemin.extend(
-                    [",".join([row_node_corr[xpos].name + ':%i' % (ypos + 1), path1]) for path1 in dup])
+            for path1 in iterSpeciationPathFromTable(path_table, row_node_corr, count, spec_pos_1, ypos - nb_node, row_id):
+                for path2 in iterSpeciationPathFromTable(path_table, row_node_corr, count, spec_pos_2, ypos - nb_node, row_id):
+                    yield ",".join([case, path1, path2])
 
-            # instead we found a lost
-            elif c == 'l':
-                lost = findSpeciationPathFromTable(
-                    path_table, row_node_corr, count, xpos, ypos - 1)
-                # add possible path of the case that lead to this lost
-                chemin.extend(
-                    [",".join([row_node_corr[xpos].name + ':%i' % (ypos + 1), path1]) for path1 in lost])
+        elif path_table[xpos, ypos] & LOST:
+            # add possible path of the case that lead to this lost
+            for path1 in iterSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos - 1, row_id):
+                yield ",".join([case, path1])
 
-    # return a list of path, the path are specially formated string
-    return chemin
+        else:
+            # add possible path of the case that lead to this duplication
+            for path1 in iterSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos + 1, row_id):
+                yield ",".join([case, path1])
 
 
-def findPathFromTable(path_table, row_node_corr, count, xpos, ypos):
+def findPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id=None):
     """ Find all the possible path from the lower left case to the leaves"""
+    return list(iterPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id))
+
 
-    chemin = []
+def iterPathFromTable(path_table, row_node_corr, count, xpos, ypos, row_id=None):
+    """Generator version of findPathFromTable : the paths are yielded one by
+    one, in the same order, so only the current path is kept in memory.
+    row_id is the row of each specie node (see rowIds), built once when
+    it's not given"""
+    if row_id is None:
+        row_id = rowIds(row_node_corr)
+    case = row_node_corr[xpos].name + ':%i' % (ypos + 1)
     # Case 1: current position correspond to a leaf
-    if(row_node_corr[xpos].is_leaf() and (ypos < 0 or path_table[xpos, ypos] is None)):
-        case = row_node_corr[xpos].name + ':%i' % (ypos + 1)
-        chemin.append(case)
+    if(row_node_corr[xpos].is_leaf() and (ypos < 0 or not path_table[xpos, ypos])):
+        yield case
 
     # Case 2 : this a internal node
     else:
         # each case can have multiple path
-        for c in path_table[xpos, ypos]:
+        for c in PATH_FLAGS:
+            if not path_table[xpos, ypos] & c:
+                continue
 
             # we found a speciation
-            if c == 's':
-                # this is bad for perfomance
-                spec_pos_1 = [x for x in row_node_corr.keys() if row_node_corr[
-                    xpos].get_child_at(0) == row_node_corr[x]][0]
-                spec_pos_2 = [x for x in row_node_corr.keys() if row_node_corr[
-                    xpos].get_child_at(1) == row_node_corr[x]][0]
-                snode = row_node_corr[xpos].name
-                nb_node = count[snode]
-                spec_1 = findPathFromTable(
-                    path_table, row_node_corr, count, spec_pos_1, ypos - nb_node)
-                spec_2 = findPathFromTable(
-                    path_table, row_node_corr, count, spec_pos_2, ypos - nb_node)
+            if c == SPEC:
+                spec_pos_1, spec_pos_2 = _childrenRows(row_node_corr, row_id, xpos)
+                nb_node = count[row_node_corr[xpos].name]
                 # add all possible path from the children
-                for path1 in spec_1:
-                    for path2 in spec_2:
-                        chemin.append(
-                            ",".join([row_node_corr[xpos].name + ':%i' % (ypos + 1), path1, path2]))
+                for path1 in iterPathFromTable(path_table, row_node_corr, count, spec_pos_1, ypos - nb_node, row_id):
+                    for path2 in iterPathFromTable(path_table, row_node_corr, count, spec_pos_2, ypos - nb_node, row_id):
+                        yield ",".join([case, path1, path2])
 
             # we found a duplication
-            elif c == 'd':
-                dup = findPathFromTable(
-                    path_table, row_node_corr, count, xpos, ypos + 1)
+            elif c == DUP:
                 # add possible path of the case that lead to this duplication
-                for path1 in dup:
-                    chemin.append(
-                        ",".join([row_node_corr[xpos].name + ':%i' % (ypos + 1), path1]))
+                for path1 in iterPathFromTable(path_table, row_node_corr, count, xpos, ypos + 1, row_id):
+                    yield ",".join([case, path1])
 
             # instead we found a lost
-            elif c == 'l':
-                lost = findSpeciationPathFromTable(
-                    path_table, row_node_corr, count, xpos, ypos - 1)
+            elif c == LOST:
                 # add possible path of the case that lead to this lost
-                for path1 in lost:
-                    chemin.append(
-                        ",".join([row_node_corr[xpos].name + ':%i' % (ypos + 1), path1]))
+                for path1 in iterSpeciationPathFromTable(path_table, row_node_corr, count, xpos, ypos - 1, row_id):
+                    yield ",".join([case, path1])
 
-    # return a list of path, the path are specially formated string
-    return chemin
+
+def rowIds(row_node_corr):
+    """Reverse of row_node_corr : the row of each specie node"""
+    return dict((node, n) for n, node in row_node_corr.iteritems())
+
+
+def _childrenRows(row_node_corr, row_id, xpos):
+    """Rows of the two children of the specie of the row xpos"""
+    node = row_node_corr[xpos]
+    return row_id[node.get_child_at(0)], row_id[node.get_child_at(1)]
 
 
 def constructFromPath(chemin, genetree, specietree, gene_matrix, node_order, verbose=False, method='upgma', cost=0):
@@ -529,7 +533,7 @@ def findSpeciationBestJoin(matrice, node_order, parent_node, node_in_tree, metho
                     min_val = matrice[x_0, x_1]
                     join_index = [x_0, x_1]
 
-    elif(method == "nj"):
+    elif(method in ClusterUtils.NJ_METHODS):
         mat_size = matrice.shape[0]
         for x_0 in child_0_list:
             for x_1 in child_1_list:
@@ -557,9 +561,24 @@ def getMatrix(node_struct, gene_matrix, node_order, ind_to_keep, got_ind=False):
         for node in node_struct:
             ind_to_keep.append(getIndex(node_order, node))
     matrix = gene_matrix  # same reference here
+    if isinstance(matrix, ClusterUtils.ClusterMatrix):
+        return matrix.submatrix(ind_to_keep)
     return numpy.take(numpy.take(matrix, ind_to_keep, axis=0), ind_to_keep, axis=1)
 
 
+def getPolytomyHash(polytomy, specietree, gene_matrix=None, node_order=None, addinfos=''):
+    """Hash of a polytomy used by the memorize cache of polySolver : the
+    structural hash of the polytomy, the hash of the specietree under its
+    lca and the digest of the distances between its children (sorted by
+    name), with addinfos. The polytomy should be mapped to specietree"""
+    infos = [SpeciesTreeIndex.tree_key(specietree & polytomy.species)]
+    if gene_matrix is not None:
+        names = sorted(child.name for child in polytomy.get_children())
+        dist = gene_matrix.submatrix([node_order.index(name) for name in names])
+        infos.append(hashlib.sha1(numpy.ascontiguousarray(dist)).hexdigest())
+    return TreeUtils.treeHash(polytomy, addinfos="".join(infos) + addinfos)
+
+
 def getIndex(node_order, node):
     """Get the index of a node in a node list"""
     return node_order.index(node.name)
@@ -609,17 +628,39 @@ def findMaxX(polytomy, specietree):
     polytomy_specie_ancestor = (specietree & polytomy.species)
     polytomy_name_set = set(polytomy.get_children_species())
 
-    for leaf in polytomy_specie_ancestor.traverse("postorder"):
+    # A node is removed when none of its remaining descendants is in
+    # polytomy_name_set (a leaf, when none of the remaining descendants of its
+    # parent is). in_subtree tells if a subtree that is not visited yet has a
+    # specie of the polytomy, and has_desc the same for the visited nodes,
+    # so the descendants are not listed again for each node
+    nodes = list(polytomy_specie_ancestor.traverse("postorder"))
+    in_subtree = {}
+    for leaf in nodes:
+        in_subtree[leaf] = leaf.name in polytomy_name_set or any(
+            [in_subtree[child] for child in leaf.children])
+    has_desc = {}
+
+    def in_set(node):
+        if node in has_desc:
+            return node.name in polytomy_name_set or has_desc[node]
+        elif node in in_subtree:
+            return in_subtree[node]
+        # a sibling of the specie of the polytomy, when it's a leaf
+        return any([n.name in polytomy_name_set for n in node.traverse()])
+
+    for leaf in nodes:
         parent = leaf.up
         if(not leaf.is_leaf()):
-            if(len(set(leaf.get_descendant_name()).intersection(polytomy_name_set)) == 0):
+            has_desc[leaf] = any([in_set(child) for child in leaf.children])
+            if not has_desc[leaf]:
                 parent.remove_child(leaf)
 
             else:
                 polytomy_name_set.add(leaf.name)
 
         else:
-            if(parent is not None) and (len(set(parent.get_descendant_name()).intersection(polytomy_name_set)) == 0):
+            has_desc[leaf] = False
+            if(parent is not None) and not any([in_set(child) for child in parent.children]):
                 parent.remove_child(leaf)
             else:
                 polytomy_name_set.add(leaf.name)
@@ -635,7 +676,7 @@ def findMaxX(polytomy, specietree):
     return polytomy_name_set, row_node_corr
 
 
-def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False, path_limit=-1, method='upgma', sol_limit=-1):
+def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False, path_limit=-1, method='upgma', sol_limit=-1, costs=None):
 
     # Start with only one polytomy
 
@@ -644,11 +685,15 @@ def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False,
     while True:
         next_tree_solution = []  # next list of partially resolved polytomies
         for tree in polysolution:
+            if(sol_limit > 0 and sol_limit < len(next_tree_solution)):
+                # the solutions of the next trees are after the first
+                # sol_limit ones, and would be dropped
+                break
             for polytomy in tree.iter_polytomies(strategy="postorder"):
                 nb_polytomy += 1
                 # copying the input for each step, necessary in order to not
-                # modify by reference
-                matrice = numpy.copy(gene_matrix)
+                # modify by reference. The copy is then condensed in place
+                matrice = ClusterUtils.copyMatrix(gene_matrix)
                 sptree = specietree.copy("newick")
                 ptree = polytomy.copy()
                 order = node_order[:]
@@ -656,8 +701,8 @@ def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False,
                 node_to_replace = polytomy
                 matrice, order = polytomyPreprocess(
                     ptree, sptree, matrice, order, method=method)
-                solution = polySolver(TreeUtils.treeHash(ptree, addinfos=str(
-                    path_limit) + method), ptree, sptree, matrice, order, path_limit, cluster_method=method, verbose=verbose)
+                solution = polySolver(getPolytomyHash(ptree, specietree, matrice, order, addinfos=str(
+                    path_limit) + method + params.get_model(costs).key), ptree, sptree, matrice, order, path_limit, cluster_method=method, verbose=verbose, costs=costs)
                 # solution=polySolver(ptree,sptree, matrice, order,path_limit, cluster_method=method, verbose=verbose)
                 if(poly_parent is None):
                     # Here we have the root. Complete solution are here
@@ -666,6 +711,8 @@ def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False,
                 else:
                     # This is one of the internal polytomy.
                     for sol in solution:
+                        if(sol_limit > 0 and sol_limit < len(next_tree_solution)):
+                            break
                         poly_parent.replace_child(node_to_replace, sol)
                         node_to_replace = sol
                         next_tree_solution.append(tree.copy())
@@ -674,9 +721,10 @@ def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False,
 
         if not next_tree_solution:
             break
-        polysolution = next_tree_solution
-        if(sol_limit > 0 and sol_limit < len(polysolution)):
+        if(sol_limit > 0 and sol_limit < len(next_tree_solution)):
             path_limit = 1
+            next_tree_solution = next_tree_solution[:sol_limit]
+        polysolution = next_tree_solution
 
     if(nb_polytomy < 1):
         raise ValueError("Polytomy not found in your gene tree")
@@ -686,7 +734,7 @@ def solvePolytomy(genetree, specietree, gene_matrix, node_order, verbose=False,
     return [t.copy("simplecopy") for t in f_sol]
 
 
-def computePolytomyReconCost(genetree, specietree, verbose=False):
+def computePolytomyReconCost(genetree, specietree, verbose=False, costs=None):
     """This is a copy pasta from the solvePolytomy function that return only the cost of a node
     """
     recon_cost = 0
@@ -699,7 +747,7 @@ def computePolytomyReconCost(genetree, specietree, verbose=False):
 
             # if node is binary, we just compute the recon cost
             try:
-                cost = TreeUtils.binaryRecScore(node, lcamap)
+                cost = TreeUtils.binaryRecScore(node, lcamap, costs=costs)
                 recon_cost += cost[0]
 
             except Exception as e:
@@ -709,8 +757,8 @@ def computePolytomyReconCost(genetree, specietree, verbose=False):
             # here, the node is a polytomy, so we compute the table and
             # find the solution cost at [-1, 0]
             sptree = specietree.copy("simplecopy")
-            mat_table, row_node = polySolver(TreeUtils.treeHash(
-                node), node, sptree, None, [], 1, verbose=verbose, mode="none")
+            mat_table, row_node = polySolver(getPolytomyHash(
+                node, specietree, addinfos=params.get_model(costs).key), node, sptree, None, [], 1, verbose=verbose, mode="none", costs=costs)
             if(verbose):
                 print(node)
                 pprint(mat_table)
@@ -721,3 +769,32 @@ def computePolytomyReconCost(genetree, specietree, verbose=False):
         else:
             raise Exception("Internal node with only one child in your tree")
     return recon_cost
+
+
+def computePolytomyReconCostSweep(genetree, specietree, costs_list):
+    """Same as computePolytomyReconCost, for each CostModel of costs_list.
+    The lca mapping, the specie count and the pruned specietree of each
+    polytomy are computed once, only the cost tables are filled for each model
+    """
+    recon_costs = numpy.zeros(len(costs_list))
+    lcamap = TreeUtils.lcaMapping(genetree, specietree, multspeciename=False)
+
+    for node in genetree.iter_internal_node(strategy="postorder", enable_root=True):
+
+        if (node.is_binary()):
+            for i, costs in enumerate(costs_list):
+                recon_costs[i] += TreeUtils.binaryRecScore(
+                    node, lcamap, costs=costs)[0]
+
+        elif(node.is_polytomy()):
+            sptree = specietree.copy("simplecopy")
+            count = TreeUtils.getSpecieCount(node)
+            polytomy_specie_set, row_node_corr = findMaxX(node, sptree)
+            for i, costs in enumerate(costs_list):
+                mat_table, path_table = fillCostTable(
+                    sptree, row_node_corr, count, max(count.values()) + 1, costs)
+                recon_costs[i] += mat_table[-1, 0]
+
+        else:
+            raise Exception("Internal node with only one child in your tree")
+    return recon_costs.tolist()
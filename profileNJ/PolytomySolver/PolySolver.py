@@ -27,7 +27,7 @@ class PolytomySolver:
     print r
     """
 
-    def __init__(self, polytomy, speciestree, lcaMapping):
+    def __init__(self, polytomy, speciestree, lcaMapping, costs=None):
         self.polytomy = polytomy
         self.speciestree = speciestree
         self.lcaMapping = lcaMapping
@@ -40,6 +40,8 @@ class PolytomySolver:
         self.dp_values = {}
         self.special_species_dupcost = {}
         self.special_species_losscost = {}
+        if costs is not None:
+            self.setDupLossCosts(costs.cdup, costs.closs)
 
     def setDupLossCosts(self, dupcost, losscost):
         self.dupcost = dupcost
@@ -430,12 +432,14 @@ class GeneTreeSolver:
     # EN changed this
     # def __init__(self, genetree, speciestree, lcaMapping):
 
-    def __init__(self, genetree, speciestree, lcaMapping, dupcost, losscost):
+    def __init__(self, genetree, speciestree, lcaMapping, dupcost=1, losscost=1, costs=None):
         self.genetree = genetree
         self.speciestree = speciestree
         self.lcaMapping = lcaMapping
         self.debug = False
         # EN changed this : set dupcost and losscost using args values
+        if costs is not None:
+            dupcost, losscost = costs.cdup, costs.closs
         self.dupcost = dupcost
         self.losscost = losscost
         self.use_dp = False
@@ -5,21 +5,14 @@ from functools import partial
 import operator
 
 
-def simpleConstruct(nodelist, nodemap, K, T, W, P, root):
+def simpleConstruct(image, K, T, W, P):
 
-    # nodelist ==> nl
+    # image ==> image tree arrays (see ImageTree)
     # K ==> ingene
     # T ==> outgene
     # W ==> multiplicity
-    # Fid : Father id
-    # image_nodes ==> P
-    # print(nodelist)
-    # parent = [(node.name, node.parent) for node in nodemap.values() if node.has_feature("parent")]
-    # print(K)
-    # print(T)
-    # print(W)
-    # print(parent)
-    # print(P)
+    # P ==> genes mapped to each node of the image tree
+    # K, T, W and P are lists indexed by the position in the image tree
 
     def insertNode(node, nodes):
         if len(nodes) == 0:
@@ -36,51 +29,92 @@ def simpleConstruct(nodelist, nodemap, K, T, W, P, root):
         node.add_child(tmp_node)
         node.add_child(nodes[-1])
 
-    # store multiple copy of a node in a list
-    nodes = ddict(partial(np.empty))
+    # the nodes of the image tree, and multiple copies of each of them
+    nodemap = [TreeClass(name=name) for name in image.names]
+    for pos in xrange(len(nodemap) - 1, 0, -1):
+        nodemap[image.parent[pos]].add_child(nodemap[pos])
+    nodes = [None] * len(nodemap)
+    # the nodes replaced by a gene, their subtree is already solved
+    genes = set()
 
-    for name in K.keys():
-        nodes[name] = np.empty(int(K[name]), dtype=object)
+    for u in reversed(image.postorder()):
 
-    for name in reversed(nodelist):
+        nodes[u] = [TreeClass() for j in xrange(K[u])]
+        node = nodemap[u]
 
-        for j in xrange(K[name]):
-            nodes[name][j] = TreeClass()
-
-        node = nodemap[name]
-
-        if W[name] > 0:
-            if node.is_leaf() and K[name] != W[name] - 1:
+        if W[u] > 0:
+            if not image.children[u] and K[u] != W[u] - 1:
                 raise Exception("This shouldn't happen")
-            elif not node.is_leaf() and K[name] < W[name]:
+            elif image.children[u] and K[u] < W[u]:
                 raise Exception("This shouldn't happen either")
 
-            if node.is_leaf():
-                for j, n in enumerate(nodes[name]):
-                    n.replace_by(P[name][j + 1])
+            if not image.children[u]:
+                for j, n in enumerate(nodes[u]):
+                    n.replace_by(P[u][j + 1])
+                    genes.add(n)
 
-                node.replace_by(P[name][0])
+                node.replace_by(P[u][0])
+                genes.add(node)
 
             else:
-                for j, pnode in enumerate(P[name]):
-                    nodes[name][K[name] - 1 - j].replace_by(pnode)
+                for j, pnode in enumerate(P[u]):
+                    nodes[u][K[u] - 1 - j].replace_by(pnode)
+                    genes.add(nodes[u][K[u] - 1 - j])
 
-        if node.up is not None:
+        if u > 0:
             j = 0
-            while j < T[name] and j < K[name]:
-                nodes[node.parent][j].add_child(nodes[name][j])
+            while j < T[u] and j < K[u]:
+                nodes[image.parent[u]][j].add_child(nodes[u][j])
                 j += 1
 
-        if T[name] < K[name]:
-            insertNode(node, nodes[name][T[name]:K[name]])
+        if T[u] < K[u]:
+            insertNode(node, nodes[u][T[u]:K[u]])
 
-    for name, node in nodemap.items():
+    for node in nodemap:
         if len(node.children) == 1:
             node.replace_by(node.children[0])
 
-    nodemap[root].delete_single_child_internal()
-
-    return nodemap[root]
+    root = nodemap[0]
+    for node in root.traverse("postorder", is_leaf_fn=genes.__contains__):
+        if(node.is_internal() and len(node.get_children()) < 2):
+            node.delete()
+
+    return root
+
+
+class ImageTree(object):
+    """Image tree of a polytomy as arrays over its nodes in preorder, from
+    TreeUtils.getImageTreeArrays : the specie name, parent position, depth
+    and children positions of each node. The root is at position 0 and a
+    node is always before its children."""
+
+    def __init__(self, specietree, ids, parent):
+        ids = ids.tolist()
+        self.names = [specietree.id2node[i].name for i in ids]
+        self.position = dict((i, pos) for pos, i in enumerate(ids))
+        self.parent = parent.tolist()
+        self.depth = specietree.lcaindex.depths[ids].tolist()
+        # same order as the children of getImageTreeNode
+        self.children = [[] for i in ids]
+        for pos in xrange(len(ids) - 1, 0, -1):
+            self.children[self.parent[pos]].append(pos)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def postorder(self):
+        """Positions of the nodes in postorder"""
+        order = []
+        stack = [(0, False)]
+        while stack:
+            pos, visited = stack.pop()
+            if visited:
+                order.append(pos)
+            else:
+                stack.append((pos, True))
+                stack.extend((child, False)
+                             for child in reversed(self.children[pos]))
+        return order
 
 
 class Solver(object):
@@ -99,29 +133,38 @@ class Solver(object):
             W[s.name] += 1
         return W, rW
 
-    def reconstruct(self):
-        images_trees = TreeUtils.getImageTreeNode(
+    def _image_mult(self, node, image):
+        """Same as _compute_mult, as lists indexed by the position in image"""
+        W = [0] * len(image)
+        rW = [[] for i in xrange(len(image))]
+        for g in node.get_children():
+            pos = image.position[self.lcamap[g].lcaid]
+            rW[pos].append(g)
+            W[pos] += 1
+        return W, rW
+
+    def _image_trees(self):
+        """Polytomies of the genetree, in postorder, and their image tree"""
+        polytomies = [node for node in self.genetree.traverse("postorder")
+                      if (node.is_root() or node.is_internal()) and not node.is_binary()]
+        TreeUtils.sortChildrenByImage(
             self.genetree, self.specietree, self.lcamap)
+        image_arrays = TreeUtils.getImageTreeArrays(
+            self.genetree, self.specietree, self.lcamap, polytomies)
+        return [(node, ImageTree(self.specietree, *image_arrays[node]))
+                for node in polytomies]
 
-        for node in self.genetree.traverse("postorder"):
-            if (node.is_root() or node.is_internal()) and not node.is_binary():
-                for n in images_trees[node].traverse():
-                    if(n.up is not None):
-                        n.add_features(parent=n.up.name)
-                W, rW = self._compute_mult(node)
-                solution = self.compute_table(images_trees[node], W, rW)
-                node.replace_by(solution)
+    def reconstruct(self):
+        # the image trees are only needed for the polytomies
+        for node, image in self._image_trees():
+            W, rW = self._image_mult(node, image)
+            solution = self.compute_table(image, W, rW)
+            node.replace_by(solution)
         return self.genetree.write(format=9)
 
-    def get_solution(self, image_tree, multiplicities, reverse_node_map, outgene, ingene):
+    def get_solution(self, image, multiplicities, reverse_node_map, outgene, ingene):
         """Reconstruct a genetree solution"""
-        nodelist = [node.name for node in image_tree.traverse("postorder")]
-        nodemap = dict((node.name, node)
-                       for node in image_tree.traverse("postorder"))
-        resolution = simpleConstruct(
-            nodelist, nodemap, ingene, outgene, multiplicities, reverse_node_map, image_tree.name)
-        # resolution.delete_single_child_internal()
-        return resolution
+        return simpleConstruct(image, ingene, outgene, multiplicities, reverse_node_map)
 
 
 class LinPolySolver(Solver):
@@ -129,12 +172,14 @@ class LinPolySolver(Solver):
     def __init__(self, genetree, specietree, lcamap):
         super(self.__class__, self).__init__(genetree, specietree, lcamap)
 
-    def compute_table(self, image_tree, W, rW):
+    def compute_table(self, image, W, rW):
         """Compute cost table"""
-        A = ddict(int)
-        B = ddict(int)
-        ingene = ddict(int)
-        outgene = ddict(int)
+        n = len(image)
+        A = [0] * n
+        B = [0] * n
+        ingene = [0] * n
+        outgene = [0] * n
+        depth = image.depth
 
         def update(a, b, degree_diff):
             if degree_diff > 2:
@@ -147,10 +192,6 @@ class LinPolySolver(Solver):
                 raise ValueError(
                     "Level difference incorrect, something is wrong")
 
-        def getAB(node_mult, *args):
-            args = sorted(args)
-            return node_mult + args[1], node_mult + args[2]
-
         def get_med(i, a, b):
             if i <= a:
                 return a
@@ -159,97 +200,90 @@ class LinPolySolver(Solver):
             else:
                 return i
 
-        # first step (1) : traverse Image node in post-order
-        for node in image_tree.traverse("postorder"):
-            mult_node = W[node.name]
+        # first step (1) : traverse Image node in post-order (the children
+        # are after their parent)
+        for u in xrange(n - 1, -1, -1):
+            mult_node = W[u]
+            children = image.children[u]
             a1, b1, a2, b2 = 0, 0, 0, 0
 
             # case where node is a leaf:
-            if node.is_leaf():
-                A[node.name] = mult_node - 1
-                B[node.name] = A[node.name]
+            if not children:
+                A[u] = mult_node - 1
+                B[u] = A[u]
 
             else:
                 # node has 2 children
-                if(len(node.get_children()) == 2):
-                    node2 = node.get_children()[1]
-                    d2 = node2.depth - node.depth
-                    a2, b2 = A[node2.name], B[node2.name]
-                    a2, b2 = update(a2, b2, d2)
+                if(len(children) == 2):
+                    node2 = children[1]
+                    a2, b2 = update(A[node2], B[node2], depth[node2] - depth[u])
                     # case where node has only one child
 
-                node1 = node.get_children()[0]
-                a1, b1 = A[node1.name], B[node1.name]
-                d1 = node1.depth - node.depth
-                a1, b1 = update(a1, b1, d1)
+                node1 = children[0]
+                a1, b1 = update(A[node1], B[node1], depth[node1] - depth[u])
 
-                # A[node.name], B[node.name] = get_A_B(mult_node, a1, a2, b1, b2)
-                A[node.name] = mult_node + min(max(a1, a2), min(b1, b2))
-                B[node.name] = mult_node + max(max(a1, a2), min(b1, b2))
+                A[u] = mult_node + min(max(a1, a2), min(b1, b2))
+                B[u] = mult_node + max(max(a1, a2), min(b1, b2))
 
         # step 2 : traversing in preorder
         # in(u) and out(u) denotes the nos. of genes
         # flowing into and out of the branch (p(u), u)
-
-        nil = list(image_tree.traverse("postorder"))
-        outgene[nil[-1].name] = 0
-        ingene[nil[-1].name] = get_med(0, A[nil[-1].name], B[nil[-1].name])
-        for i in range(len(nil) - 2, -1, -1):
-
-            node = nil[i]
-            father = node.up
-            t = ingene[father.name] - W[father.name]
-            if node.depth - father.depth > 2:
+        outgene[0] = 0
+        ingene[0] = get_med(0, A[0], B[0])
+        for u in xrange(1, n):
+            father = image.parent[u]
+            t = ingene[father] - W[father]
+            if depth[u] - depth[father] > 2:
                 t = 0
 
-            outgene[node.name] = t
-            ingene[node.name] = get_med(t, A[node.name], B[node.name])
+            outgene[u] = t
+            ingene[u] = get_med(t, A[u], B[u])
 
-        return self.get_solution(image_tree, W, rW, outgene, ingene)
+        return self.get_solution(image, W, rW, outgene, ingene)
 
 
 class DynPolySolver(Solver):
 
-    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1):
+    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1, costs=None):
         super(self.__class__, self).__init__(genetree, specietree, lcamap)
+        if costs is not None:
+            dupcost, losscost = costs.cdup, costs.closs
         self.dupcost = dupcost + 2 * losscost
         self.losscost = losscost
 
-    def compute_table(self, image_tree, W, rW):
+    def compute_table(self, image, W, rW):
         """ Compute table for dynamique programmation"""
-        U = ddict(partial(np.zeros))
-        M = ddict(int)
-        I = ddict(partial(np.zeros))
-        # print( image_tree
-
-        outgene = ddict(int)
-        ingene = ddict(int)
-
-        for node in image_tree.traverse("postorder"):
-            mult_node = W[node.name]
-            if node.is_leaf():
-                M[node.name] = mult_node - 1
-            elif len(node.get_children()) == 1:
-                M[node.name] = M[node.get_child_at(0).name] + mult_node
-
-            elif node.is_binary():
-                v1 = M[node.get_child_at(0).name]
-                v2 = M[node.get_child_at(1).name]
-                M[node.name] = mult_node + max(v1, v2)
+        n = len(image)
+        parent, depth = image.parent, image.depth
+        U = [None] * n
+        M = [0] * n
+        I = [None] * n
+
+        outgene = [0] * n
+        ingene = [0] * n
+
+        for u in xrange(n - 1, -1, -1):
+            mult_node = W[u]
+            children = image.children[u]
+            if not children:
+                M[u] = mult_node - 1
+            elif len(children) == 1:
+                M[u] = M[children[0]] + mult_node
+
+            elif len(children) == 2:
+                M[u] = mult_node + max(M[children[0]], M[children[1]])
 
             else:
                 raise ValueError(
                     "Shouldn't have a polytomy in the image tree, something wrong")
 
-        if image_tree.is_root() and image_tree.is_leaf():
-            outgene = ddict(int)
-            ingene = ddict(int)
-            outgene[image_tree.name] = 0
-            ingene[image_tree.name] = W[image_tree.name] - 1
-            return self.get_solution(image_tree, W, rW, outgene, ingene)
+        if n == 1:
+            outgene[0] = 0
+            ingene[0] = W[0] - 1
+            return self.get_solution(image, W, rW, outgene, ingene)
 
-        mul = M[image_tree.name]
-        C = np.zeros(mul + 1)
+        mul = M[0]
+        C = [0.0] * (mul + 1)
 
         def getCost(inp, out, d):
             m = min(float(d) * self.losscost, self.dupcost)
@@ -258,80 +292,75 @@ class DynPolySolver(Solver):
             else:
                 return m * float(inp) + self.dupcost * float(out - inp)
 
-        def getMin(node, inp, d):
-            w = W[node.name]
+        def getMin(u, inp, d):
+            w = W[u]
             l = C
             p, m = w, getCost(inp, w, d) + l[w]
-            for out in xrange(w + 1, M[node.name] + 1):
+            for out in xrange(w + 1, M[u] + 1):
                 t = getCost(inp, out, d) + l[out]
                 if t < m:
                     p, m = out, t
-            U[node.name][inp] = m
-            I[node.name][inp] = p
-
-        def getC(node, w):
-            if len(node.get_children()) == 1:
-                left_u = U[node.get_child_at(0).name]
-                for j in xrange(w, M[node.name] + 1):
+            U[u][inp] = m
+            I[u][inp] = p
+
+        def getC(u, w):
+            children = image.children[u]
+            if len(children) == 1:
+                left_u = U[children[0]]
+                for j in xrange(w, M[u] + 1):
                     C[j] = left_u[j - w]
 
-            elif len(node.get_children()) == 2:
-                left_u = U[node.get_child_at(0).name]
-                right_u = U[node.get_child_at(1).name]
-                for j in xrange(w, M[node.name] + 1):
+            elif len(children) == 2:
+                left_u = U[children[0]]
+                right_u = U[children[1]]
+                for j in xrange(w, M[u] + 1):
                     C[j] = left_u[j - w] + right_u[j - w]
 
-        for node in image_tree.traverse("postorder"):
-            mult_node = W[node.name]
+        for u in xrange(n - 1, -1, -1):
+            mult_node = W[u]
 
-            if node.is_leaf():
-                U[node.name] = np.zeros(M[node.parent] - W[node.parent] + 1)
-                I[node.name] = np.zeros(
-                    M[node.parent] - W[node.parent] + 1, dtype=int)
-                depth_diff = node.depth - node.up.depth
-                for j in xrange(0, M[node.parent] - W[node.parent] + 1):
-                    U[node.name][j] = getCost(j, mult_node - 1, depth_diff)
-                    I[node.name][j] = mult_node - 1
+            if u == 0:
+                U[u] = [0.0]
+                I[u] = [0]
+                getC(u, mult_node)
+                getMin(u, 0, 0)
 
-            elif node.is_root():
-                U[node.name] = np.zeros(1)
-                I[node.name] = np.zeros(1, dtype=int)
-                getC(node, mult_node)
-                getMin(node, 0, 0)
+            elif not image.children[u]:
+                size = M[parent[u]] - W[parent[u]] + 1
+                depth_diff = depth[u] - depth[parent[u]]
+                U[u] = [getCost(j, mult_node - 1, depth_diff)
+                        for j in xrange(0, size)]
+                I[u] = [mult_node - 1] * size
 
             else:
-                U[node.name] = np.zeros(M[node.parent] - W[node.parent] + 1)
-                I[node.name] = np.zeros(
-                    M[node.parent] - W[node.parent] + 1, dtype=int)
-                getC(node, mult_node)
-                depth_diff = node.depth - node.up.depth
-                for j in xrange(0, M[node.parent] - W[node.parent] + 1):
-                    getMin(node, j, depth_diff)
-
-        ingene[image_tree.name] = I[image_tree.name][0]
-        outgene[image_tree.name] = 0
-        for node in reversed(image_tree.get_descendants("postorder")):
-            outgene[node.name] = ingene[node.parent] - W[node.parent]
-            depth_diff = node.depth - node.up.depth
+                size = M[parent[u]] - W[parent[u]] + 1
+                U[u] = [0.0] * size
+                I[u] = [0] * size
+                getC(u, mult_node)
+                depth_diff = depth[u] - depth[parent[u]]
+                for j in xrange(0, size):
+                    getMin(u, j, depth_diff)
+
+        ingene[0] = I[0][0]
+        outgene[0] = 0
+        for u in xrange(1, n):
+            outgene[u] = ingene[parent[u]] - W[parent[u]]
+            depth_diff = depth[u] - depth[parent[u]]
 
             if (depth_diff * self.losscost) > self.dupcost:
-                outgene[node.name] = 0
+                outgene[u] = 0
 
-            ingene[node.name] = I[node.name][outgene[node.name]]
+            ingene[u] = I[u][outgene[u]]
 
-        # print( 'outgene ===> ', outgene)
-        # print( 'ingene ===> ', ingene_
-        # print( 'I == >', I_
-        # print( 'W == >', W_
-        # print( 'M == >', M)
-
-        return self.get_solution(image_tree, W, rW, outgene, ingene)
+        return self.get_solution(image, W, rW, outgene, ingene)
 
 
 class NotungSolver(Solver):
 
-    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1):
+    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1, costs=None):
         super(self.__class__, self).__init__(genetree, specietree, lcamap)
+        if costs is not None:
+            dupcost, losscost = costs.cdup, costs.closs
         # current version is not working if you want more that one solution
         # will let it that way for now, because we don't really need that in the simulation
         # comparision
@@ -504,33 +533,30 @@ class NotungSolver(Solver):
 
 class Dynamiq2(Solver):
 
-    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1):
+    def __init__(self, genetree, specietree, lcamap, dupcost=1, losscost=1, costs=None):
         super(self.__class__, self).__init__(genetree, specietree, lcamap)
+        if costs is not None:
+            dupcost, losscost = costs.cdup, costs.closs
         self.dupcost = dupcost
         self.losscost = losscost
 
     def reconstruct(self):
-        images_trees = TreeUtils.getImageTreeNode(
-            self.genetree, self.specietree, self.lcamap)
-
-        for node in self.genetree.traverse("postorder"):
-            if (node.is_root() or node.is_internal()) and not node.is_binary():
-                for n in images_trees[node].traverse():
-                    if(n.up is not None):
-                        n.add_features(parent=n.up.name)
-                W, rW = self._compute_mult(node)
-                solution = self.compute_table(images_trees[node], node, W, rW)
-                node.replace_by(solution)
+        # the image trees are only needed for the polytomies
+        for node, image in self._image_trees():
+            W, rW = self._image_mult(node, image)
+            solution = self.compute_table(image, node, W, rW)
+            node.replace_by(solution)
         return self.genetree.write(format=9)
 
-    def compute_table(self, image_tree, node, W, rW):
+    def compute_table(self, image, node, W, rW):
         """Compute cost table"""
 
         child_len = len(node.get_children())
-        costTable = ddict(partial(np.zeros))
-        ingene = ddict(int)
-        outgene = ddict(int)
-        # print( image_tree)
+        n = len(image)
+        parent, depth = image.parent, image.depth
+        costTable = [None] * n
+        ingene = [0] * n
+        outgene = [0] * n
 
         def getCost(w_u, k):
             return self.dupcost if w_u > k else self.losscost
@@ -538,52 +564,52 @@ class Dynamiq2(Solver):
         def getWbar(c_u):
             return min(self.dupcost + self.losscost, c_u * self.losscost)
 
-        for node in image_tree.traverse("postorder"):
-            costTable[node.name] = np.zeros(child_len)
-            ingene[node.name] = +np.inf
+        for u in xrange(n - 1, -1, -1):
+            children = image.children[u]
+            costTable[u] = [0.0] * child_len
+            ingene[u] = +np.inf
             c_u = 0
-            if(node.up is not None):
-                c_u = node.depth - node.up.depth - 1
+            if(u > 0):
+                c_u = depth[u] - depth[parent[u]] - 1
             w_bar = getWbar(c_u)
-            w_u = W[node.name]
+            w_u = W[u]
             for k in xrange(1, child_len + 1):
                 w = getCost(w_u, k)
 
-                if len(node.get_children()) == 0:
-                    costTable[node.name][k - 1] = w_bar * \
+                if len(children) == 0:
+                    costTable[u][k - 1] = w_bar * \
                         min(k, w_u) + w * abs(k - w_u)
-                    ingene[node.name] = w_u - 1
+                    ingene[u] = w_u - 1
 
-                elif len(node.get_children()) == 1:
-                    child = node.get_children()[0]
+                elif len(children) == 1:
+                    child = children[0]
                     val_on_kp = []
                     for k_p in xrange(1, child_len + 1):
                         dt = w_bar * min(k, w_u) + w * abs(k - w_u - k_p)
                         val_on_kp.append(
-                            dt + k_p * self.losscost + costTable[child.name][k_p - 1])
-                    min_kp, costTable[node.name][
+                            dt + k_p * self.losscost + costTable[child][k_p - 1])
+                    min_kp, costTable[u][
                         k - 1] = min(enumerate(val_on_kp), key=operator.itemgetter(1))
-                    ingene[node.name] = min(min_kp + w_u, ingene[node.name])
+                    ingene[u] = min(min_kp + w_u, ingene[u])
 
-                elif len(node.get_children()) == 2:
-                    child1 = node.get_children()[0]
-                    child2 = node.get_children()[1]
+                elif len(children) == 2:
+                    child1, child2 = children
                     val_on_kp = []
                     for k_p in xrange(1, child_len + 1):
                         dt = w_bar * min(k, w_u) + w * abs(k - w_u - k_p)
                         val_on_kp.append(
-                            dt + costTable[child1.name][k_p - 1] + costTable[child2.name][k_p - 1])
-                    min_kp, costTable[node.name][
+                            dt + costTable[child1][k_p - 1] + costTable[child2][k_p - 1])
+                    min_kp, costTable[u][
                         k - 1] = min(enumerate(val_on_kp), key=operator.itemgetter(1))
-                    ingene[node.name] = min(min_kp + w_u, ingene[node.name])
+                    ingene[u] = min(min_kp + w_u, ingene[u])
 
-        outgene[image_tree.name] = 0
+        outgene[0] = 0
 
-        for node in reversed(image_tree.get_descendants("postorder")):
-            outgene[node.name] = ingene[node.parent] - W[node.parent]
-            depth_diff = node.depth - node.up.depth
+        for u in xrange(1, n):
+            outgene[u] = ingene[parent[u]] - W[parent[u]]
+            depth_diff = depth[u] - depth[parent[u]]
 
             if (depth_diff * self.losscost) > self.dupcost:
-                outgene[node.name] = 0
+                outgene[u] = 0
 
-        return self.get_solution(image_tree, W, rW, outgene, ingene)
+        return self.get_solution(image, W, rW, outgene, ingene)
@@ -7,9 +7,11 @@
 __author__ = "Emmanuel Noutahi"
 
 from TreeClass import TreeClass
+import hashlib
 import os
 import numpy as np
 from StringIO import StringIO
+from itertools import chain
 import random
 try:
     from lxml import etree
@@ -27,6 +29,18 @@ except ImportError:
 np.set_printoptions(precision=3)
 numerictypes = np.core.numerictypes.sctype2char
 Float = numerictypes(float)
+# clustering methods that use the neighbor joining criterion
+NJ_METHODS = ('nj', 'rapidnj')
+# number of sorted columns checked at first in each row by RAPIDNJ_cluster
+RAPIDNJ_BLOCK = 8
+# extension of the binary distance matrix cache
+CACHE_EXT = '.npy'
+# relative difference under which two distances are considered as a tie by
+# the nearest-neighbor chain algorithm
+NNCHAIN_TOL = 1e-9
+# number of rows under which NJ_cluster sums the rows again for each join,
+# instead of using the row sums kept up to date
+NJ_EXACT_SIZE = 4
 
 
 def find_smallest_index(matrice):
@@ -50,11 +64,15 @@ def condense_matrix(matrice, smallest_index, method='upgma'):
     it is never chosen again with find_smallest_index.
     Now the new regroupement distance value is at the first position! (on row and column)
     """
+    if isinstance(matrice, ClusterMatrix):
+        matrice.condense(smallest_index, method=method)
+        return matrice
+
     first_index, second_index = smallest_index
     # get the rows and make a new vector by updating distance
     rows = np.take(matrice, smallest_index, 1)
     # default we use upgma
-    if(method.lower() == 'nj'):
+    if(method.lower() in NJ_METHODS):
         new_vector = (
             np.sum(rows, 1) - matrice[first_index, second_index]) * 0.5
 
@@ -79,6 +97,255 @@ def remove_ij(x, i, j):
     return y
 
 
+class ClusterMatrix(object):
+    """Distance matrice condensed in place during a clustering
+
+    The distances are kept in a single buffer that is never reallocated.
+    Each row (slot) of the buffer is either active or inactive, and index
+    holds the active slots in the order of the condensed matrice, so that
+    a ClusterMatrix can be indexed like the matrice returned by
+    condense_matrix. When a pair is joined, the result is written in the
+    slot of the second index and the slot of the first index is marked as
+    inactive. When half of the slots are inactive, the active rows are
+    moved to the beginning of the buffer (still without reallocation).
+
+    labels is an optional list of objects (TreeClass nodes) corresponding to
+    the rows of the matrice, that is updated by join.
+    """
+
+    def __init__(self, matrice, labels=None, copy=False):
+        if isinstance(matrice, ClusterMatrix):
+            matrice = matrice.to_array()
+            copy = False
+        self.buffer = np.array(matrice, copy=copy, order='C')
+        self._data = self.buffer.reshape(-1)
+        n = self.buffer.shape[0]
+        self.size = n
+        self.active = np.ones(n, dtype=bool)
+        self.index = np.arange(n)
+        self._upper = ~np.tri(n, k=-1, dtype=bool)
+        self.labels = list(labels) if labels is not None else None
+        self.row_sums = None
+        self._scratch = None
+
+    @property
+    def shape(self):
+        return (self.size, self.size)
+
+    @property
+    def slots(self):
+        """Active slots, in the order of the condensed matrice"""
+        return self.index[:self.size]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = [self.slots[k] for k in key]
+        return self._block(rows, cols)
+
+    def __len__(self):
+        return self.size
+
+    def to_array(self):
+        """Return a copy of the condensed matrice as a np array"""
+        return self._block(self.slots, self.slots)
+
+    def submatrix(self, ind):
+        """Return the np array of the rows and columns ind of the matrice,
+        same as numpy.take on both axis"""
+        slots = self.slots[ind]
+        return self._block(slots, slots)
+
+    def _block(self, rows, cols):
+        """Distances between the slots rows and cols"""
+        if np.ndim(rows) and np.ndim(cols):
+            return self.buffer[np.ix_(rows, cols)]
+        return self.buffer[rows, cols]
+
+    def _distances(self, slot):
+        """Distances from all the slots to slot"""
+        return self.buffer[:, slot]
+
+    def _set_row(self, slot, vector):
+        """Set the distances from slot to all the slots"""
+        self.buffer[slot] = vector
+        self.buffer[:, slot] = vector
+        np.fill_diagonal(self.buffer, 0)
+
+    def copy(self):
+        """Return a new ClusterMatrix, with a copy of the active rows"""
+        labels = self.get_labels() if self.labels is not None else None
+        return ClusterMatrix(self.to_array(), labels=labels)
+
+    def get_labels(self):
+        """Return the labels of the active rows"""
+        return [self.labels[slot] for slot in self.slots]
+
+    def compute_row_sums(self):
+        """Compute the sum of each row, they are then kept up to date
+        by condense, as in NJ_cluster"""
+        self.row_sums = np.zeros(self.buffer.shape[0])
+        self.row_sums[self.slots] = np.sum(self.to_array(), 1)
+
+    def q_matrix(self):
+        """Q matrix for nj, indexed by slot (see calculate_Q_matrix), in
+        the scratch matrice"""
+        values = self._scratch_matrix()
+        np.multiply(self.buffer, self.size - 2, out=values)
+        values -= self.row_sums[:, np.newaxis]
+        values -= self.row_sums
+        return values
+
+    def _scratch_matrix(self):
+        """Float matrice of the shape of the buffer, allocated only once"""
+        n = self.buffer.shape[0]
+        if self._scratch is None:
+            self._scratch = np.empty(n * n)
+        return self._scratch[:n * n].reshape(n, n)
+
+    def find_smallest_index(self, values=None):
+        """Same as find_smallest_index on the condensed matrice
+
+        values can be given as a matrice indexed by slot (Q matrix), it's
+        then changed in-place. By default the distances are used.
+        """
+        if values is None:
+            values = self._scratch_matrix()
+            values[:] = self.buffer
+        n = values.shape[0]
+        inactive = ~self.active
+        values[self._upper[:n, :n]] = np.inf
+        values[inactive] = np.inf
+        values[:, inactive] = np.inf
+        row, col = divmod(values.argmin(), n)
+        return tuple(np.searchsorted(self.slots, [row, col]))
+
+    def condense(self, smallest_index, method='upgma'):
+        """Join two rows of the matrice, same as condense_matrix"""
+        first_index, second_index = smallest_index
+        first, second = self.index[first_index], self.index[second_index]
+        rows = np.column_stack(
+            (self._distances(first), self._distances(second)))
+        if self.row_sums is not None:
+            self.row_sums -= rows[:, 0] + rows[:, 1]
+        if(method.lower() in NJ_METHODS):
+            new_vector = (np.sum(rows, 1) - rows[first, 1]) * 0.5
+        else:
+            new_vector = np.average(rows, 1)
+
+        self._set_row(second, new_vector)
+        self.active[first] = False
+        self.index[first_index:self.size - 1] = \
+            self.index[first_index + 1:self.size]
+        self.size -= 1
+        if self.row_sums is not None:
+            new_vector = self._distances(second)
+            self.row_sums += new_vector
+            self.row_sums[second] = np.sum(new_vector[self.slots])
+        if 2 * self.size <= len(self.active):
+            self._compact()
+
+    def join(self, smallest_index, method='upgma'):
+        """Join two labels, as condense_node_order, then condense the matrice.
+        The new node is returned"""
+        index1, index2 = smallest_index
+        dist = node_distance(self, smallest_index, method)
+        slot1, slot2 = self.index[index1], self.index[index2]
+        new_node = join_nodes(self.labels[slot1], self.labels[slot2], dist)
+        self.labels[slot2] = new_node
+        self.condense(smallest_index, method=method)
+        return new_node
+
+    def _compact(self):
+        """Move the active rows at the beginning of the buffer"""
+        slots = np.copy(self.slots)
+        n = self.size
+        # a row is always moved before its position, and never before the
+        # end of the previous row, so nothing is overwritten before being read
+        for k, slot in enumerate(slots):
+            self._data[k * n:(k + 1) * n] = self.buffer[slot, slots]
+        self.buffer = self._data[:n * n].reshape(n, n)
+        self.active = self.active[:n]
+        self.active[:] = True
+        self.index[:n] = np.arange(n)
+        if self.row_sums is not None:
+            self.row_sums = self.row_sums[slots]
+        if self.labels is not None:
+            self.labels = [self.labels[slot] for slot in slots]
+
+
+class CondensedMatrix(ClusterMatrix):
+    """ClusterMatrix stored as a condensed upper triangular matrice
+
+    Only the distances d(i, j), i < j, are kept in a 1D buffer of size
+    n(n-1)/2 (same order as scipy pdist), with float32 precision by default,
+    which needs about 4 times less memory than the square float64 matrice.
+    The diagonal is always 0. matrice can be a square np array or a
+    ClusterMatrix. Rows and submatrices are returned as float64 np arrays.
+
+    Only the partial joins (condense) are done on the condensed buffer, a
+    full clustering with NJ_cluster or UPGMA_cluster is done on a
+    square copy.
+    """
+
+    def __init__(self, matrice, labels=None, dtype=None):
+        if dtype is None:
+            dtype = matrice.buffer.dtype if isinstance(
+                matrice, CondensedMatrix) else np.float32
+        n = matrice.shape[0]
+        self.n = n
+        self.buffer = np.empty(n * (n - 1) // 2, dtype=dtype)
+        for i in xrange(n - 1):
+            start = self._pos(i, i + 1)
+            self.buffer[start:start + n - i - 1] = matrice[i][i + 1:]
+        self.size = n
+        self.active = np.ones(n, dtype=bool)
+        self.index = np.arange(n)
+        self.labels = list(labels) if labels is not None else None
+        self.row_sums = None
+
+    def _pos(self, i, j):
+        """Position of d(i, j), i < j, in the buffer"""
+        return i * (2 * self.n - i - 1) // 2 + j - i - 1
+
+    def _row_pos(self, slot):
+        """Position of the distances from slot to the slots before it, and
+        position of the first distance to the slots after it"""
+        before = np.arange(slot)
+        return self._pos(before, slot), self._pos(slot, slot + 1)
+
+    def _distances(self, slot):
+        row = np.zeros(self.n)
+        before, start = self._row_pos(slot)
+        row[:slot] = self.buffer[before]
+        row[slot + 1:] = self.buffer[start:start + self.n - slot - 1]
+        return row
+
+    def _set_row(self, slot, vector):
+        before, start = self._row_pos(slot)
+        self.buffer[before] = vector[:slot]
+        self.buffer[start:start + self.n - slot - 1] = vector[slot + 1:]
+
+    def _block(self, rows, cols):
+        if np.ndim(rows) == 0:
+            return self._distances(rows)[cols]
+        elif np.ndim(cols) == 0:
+            return self._distances(cols)[rows]
+        block = np.zeros((len(rows), len(cols)))
+        for i, row in enumerate(rows):
+            block[i] = self._distances(row)[cols]
+        return block
+
+    def copy(self):
+        """Return a new CondensedMatrix, with a copy of the active rows"""
+        labels = self.get_labels() if self.labels is not None else None
+        return CondensedMatrix(self, labels=labels)
+
+    def _compact(self):
+        # the inactive distances are never read, nothing to do
+        pass
+
+
 def calculate_Q_ij(matrice, ind, n):
     """Calcutates Q_matrix for two taxa
 
@@ -89,16 +356,11 @@ def calculate_Q_ij(matrice, ind, n):
 def calculate_Q_matrix(matrice):
     """Calculate Q_matrix for nj algorithm
 
+    The whole matrix is obtained with a single broadcast expression.
     """
     n = matrice.shape[0]
-    Q_matrix = np.zeros(shape=matrice.shape)
-    it = np.nditer(matrice, flags=['multi_index'])
-    while not it.finished:
-        ind = it.multi_index
-        Q_matrix[ind] = calculate_Q_ij(matrice, ind, n)
-        it.iternext()
-
-    return Q_matrix
+    row_sums = np.sum(matrice, 1)
+    return (n - 2) * matrice - row_sums[:, np.newaxis] - row_sums
 
 
 def paired_node_distance(matrice, smallest_index):
@@ -139,17 +401,33 @@ def condense_node_order(matrice, smallest_index, node_order, method='upgma'):
     node2 = node_order[index2]
     # get the distance between the nodes and assign 1/2 the distance to the
     # Length property of each node
+    dist = node_distance(matrice, smallest_index, method)
+    new_node = join_nodes(node1, node2, dist)
+    # replace the object at index1 with the combined node
+    node_order[index2] = new_node
+    # replace the object at index2 with None
+    del node_order[index1]  # distance at i=index2 || j=index2
+    return node_order
 
-    if(method.lower() == 'nj'):
-        dist = paired_node_distance(matrice, smallest_index)
+
+def node_distance(matrice, smallest_index, method='upgma'):
+    """Branch length of the two nodes at smallest_index, for a join"""
+    index1, index2 = smallest_index
+    if(method.lower() in NJ_METHODS):
+        return paired_node_distance(matrice, smallest_index)
 
     elif(method.lower() == 'upgma'):
         distance = matrice[index1, index2]
-        dist = (distance / 2.0, distance / 2.0)
+        return (distance / 2.0, distance / 2.0)
 
     else:
-        dist = (0, 0)
+        return (0, 0)
+
 
+def join_nodes(node1, node2, dist):
+    """Combine node1 and node2 into a new TreeClass node.
+    dist is the tuple of branch length of node1 and node2, it's set as the
+    length feature of each node"""
     nodes = [node1, node2]
     pos = [0, 1]
 
@@ -160,11 +438,7 @@ def condense_node_order(matrice, smallest_index, node_order, method='upgma'):
     new_node.add_child(node1)
     new_node.add_child(node2)
     new_node.add_features(length=sum(dist))
-    # replace the object at index1 with the combined node
-    node_order[index2] = new_node
-    # replace the object at index2 with None
-    del node_order[index1]  # distance at i=index2 || j=index2
-    return node_order
+    return new_node
 
 
 def NJ_cluster(matrice, node_order, nj_depth=None):
@@ -184,15 +458,245 @@ def NJ_cluster(matrice, node_order, nj_depth=None):
 
     tree = None
     smallest_index = []
+    cluster_mat = ClusterMatrix(matrice, labels=node_order)
+    # row sums are kept up to date after each join, instead of being
+    # computed again for each cell of the Q matrix
+    cluster_mat.compute_row_sums()
     for i in range(nj_depth):
-        Q_matrix = calculate_Q_matrix(matrice)
-        index_1, index_2 = find_smallest_index(Q_matrix)
-        smallest_index = (index_1, index_2)
-        row_order = condense_node_order(
-            matrice, smallest_index, node_order, method='nj')
-        matrice = condense_matrix(matrice, smallest_index, method='nj')
-        tree = node_order[smallest_index[1]]
-    return tree, matrice, smallest_index
+        if cluster_mat.size <= NJ_EXACT_SIZE:
+            # the last joins are ties (equal Q for complementary pairs),
+            # the exact sums break them as the full computation does
+            cluster_mat.compute_row_sums()
+        smallest_index = cluster_mat.find_smallest_index(
+            cluster_mat.q_matrix())
+        tree = cluster_mat.join(smallest_index, method='nj')
+    return tree, _cluster_result(matrice, cluster_mat, node_order), smallest_index
+
+
+def _cluster_result(matrice, cluster_mat, node_order):
+    """Update node_order after a clustering with cluster_mat and return the
+    condensed matrice, with the same type as matrice"""
+    node_order[:] = cluster_mat.get_labels()
+    if isinstance(matrice, ClusterMatrix):
+        return cluster_mat
+    return cluster_mat.to_array()
+
+
+class _RapidNJRows(object):
+    """Sorted rows of a distance matrice, used by RAPIDNJ_cluster
+
+    The matrice is used as a buffer of slots : a joined pair is stored in the
+    slot of its smallest index and the slot of its largest index is marked as
+    inactive. cols[row_of[i]] is the list of slots sorted by their distance
+    to slot i (dists[row_of[i]] holds the distances).
+    A sorted entry of row i toward slot j is only valid if j is still active
+    and if the node in j was not created after row i was sorted
+    (born[j] <= sorted_at[i]).
+    """
+
+    def __init__(self, matrice):
+        self.matrice = matrice
+        n = matrice.shape[0]
+        self.active = np.ones(n, dtype=bool)
+        self.born = np.zeros(n, dtype=int)
+        self.sorted_at = np.zeros(n, dtype=int)
+        self.row_of = np.zeros(n, dtype=int)
+        self.rebuild(0)
+
+    def rebuild(self, clock):
+        """Sort again the rows of all the active slots"""
+        slots = np.flatnonzero(self.active)
+        submat = self.matrice[np.ix_(slots, slots)]
+        order = np.argsort(submat, axis=1, kind='mergesort')
+        self.dists = submat[np.arange(slots.size)[:, np.newaxis], order]
+        self.cols = slots[order]
+        self.row_of[slots] = np.arange(slots.size)
+        self.sorted_at[slots] = clock
+
+    def resort(self, slot, clock):
+        """Sort the row of a new node, stored in slot"""
+        slots = np.flatnonzero(self.active)
+        values = self.matrice[slot, slots]
+        order = np.argsort(values, kind='mergesort')
+        row = self.row_of[slot]
+        self.cols[row, :slots.size] = slots[order]
+        self.cols[row, slots.size:] = slot
+        self.dists[row, :slots.size] = values[order]
+        self.dists[row, slots.size:] = np.inf
+        self.born[slot] = clock
+        self.sorted_at[slot] = clock
+
+    def find_pair(self, row_sums):
+        """Return the pair of slots (i, j), i > j, with the smallest Q value
+
+        Ties are broken as in NJ_cluster: of the pairs with the same Q value,
+        the first one in the row-major scan of the lower triangle (smallest
+        i, then smallest j) is returned.
+        Each row is scanned by blocks of increasing size, until the lower
+        bound (n-2)*d(i,j) - r(i) - max(r) of its remaining entries is
+        larger than the best Q value.
+        """
+        slots = np.flatnonzero(self.active)
+        n = slots.size
+        if n == 2:
+            return slots[1], slots[0]
+        r_max = np.max(row_sums[slots])
+        width = self.cols.shape[1]
+        best_q = np.inf
+        best = []
+        start, stop = 0, min(RAPIDNJ_BLOCK, width)
+        pending = slots
+        while pending.size:
+            rows = self.row_of[pending]
+            cols = self.cols[rows, start:stop]
+            dists = self.dists[rows, start:stop]
+            slot_i = pending[:, np.newaxis]
+            valid = self.active[cols] & (cols != slot_i) & (
+                self.born[cols] <= self.sorted_at[pending][:, np.newaxis])
+            # same operation order as calculate_Q_matrix, where the largest
+            # index is the row
+            first = np.maximum(cols, slot_i)
+            second = np.minimum(cols, slot_i)
+            q_vals = (n - 2) * dists - row_sums[first] - row_sums[second]
+            q_vals[~valid] = np.inf
+            q_min = np.min(q_vals)
+            if q_min < best_q:
+                best_q = q_min
+                best = []
+            if q_min == best_q and q_min < np.inf:
+                found = q_vals == q_min
+                best.extend(zip(first[found], second[found]))
+
+            if stop == width:
+                break
+            bounds = (n - 2) * self.dists[rows, stop] - \
+                row_sums[pending] - r_max
+            # small margin, so that rounding errors can't hide a tie
+            margin = 1e-12 * (np.abs(row_sums[pending]) + abs(r_max) +
+                              abs(best_q))
+            pending = pending[bounds - margin <= best_q]
+            start, stop = stop, min(2 * stop, width)
+
+        return min(best)
+
+
+def RAPIDNJ_cluster(matrice, node_order, rapidnj_depth=None):
+    """
+    Node clustering with NJ, using the bounded search of RapidNJ
+    (Simonsen et al., Rapid Neighbour-Joining, WABI 2008)
+    matrice is a np array.
+    node_order is a list of TreeClass objects corresponding to the matrice.
+
+    The rows of the matrice are sorted once, and only the beginning of each
+    row is checked to find the pair to join. The joins are the same as
+    NJ_cluster, but the whole Q matrix is never computed, which is much
+    faster for large matrices. The returned matrice and smallest_index
+    are also the same as NJ_cluster.
+
+    WARNING: Changes matrice in-place.
+    """
+    num_entries = len(node_order)
+    if not rapidnj_depth or rapidnj_depth > (num_entries - 1):
+        rapidnj_depth = num_entries - 1
+
+    matrice = np.asarray(matrice, dtype=float)
+    tree = None
+    smallest_index = []
+    sorted_rows = _RapidNJRows(matrice)
+    active = sorted_rows.active
+    row_sums = np.sum(matrice, 1)
+    n = num_entries
+    for i in range(rapidnj_depth):
+        # sort all the rows again when half of them are no longer active
+        if 2 * n < sorted_rows.cols.shape[1]:
+            sorted_rows.rebuild(i)
+        if n <= NJ_EXACT_SIZE:
+            # exact sums, as in NJ_cluster
+            slots = np.flatnonzero(active)
+            row_sums[slots] = np.sum(matrice[np.ix_(slots, slots)], 1)
+        slot_1, slot_2 = sorted_rows.find_pair(row_sums)
+        slots = np.flatnonzero(active)
+        smallest_index = (np.searchsorted(slots, slot_1),
+                          np.searchsorted(slots, slot_2))
+        # branch lengths, computed as condense_node_order would do it
+        x = np.sum(matrice[slot_1, slots]) - np.sum(matrice[slots, slot_2])
+        distance = matrice[slot_1, slot_2]
+        if(n - 2 > 0):
+            dist_1 = 0.5 * distance + ((0.5 / (n - 2)) * (x))
+            dist = (dist_1, distance - dist_1)
+        else:
+            dist = (distance / 2.0, distance / 2.0)
+        tree = join_nodes(node_order[slot_1], node_order[slot_2], dist)
+        node_order[slot_2] = tree
+
+        rows = matrice[:, [slot_1, slot_2]]
+        row_sums -= rows[:, 0] + rows[:, 1]
+        new_vector = (np.sum(rows, 1) - distance) * 0.5
+        active[slot_1] = False
+        new_vector[slot_2] = 0
+        matrice[slot_2] = new_vector
+        matrice[:, slot_2] = new_vector
+        n -= 1
+        slots = np.flatnonzero(active)
+        row_sums += matrice[:, slot_2]
+        row_sums[slot_2] = np.sum(matrice[slot_2, slots])
+        sorted_rows.resort(slot_2, i + 1)
+
+    slots = np.flatnonzero(active)
+    node_order[:] = [node_order[s] for s in slots]
+    return tree, matrice[np.ix_(slots, slots)], smallest_index
+
+
+def _near_tie(val1, val2):
+    """Check if two distances are equal, or too close to be compared safely"""
+    diff = abs(val1 - val2)
+    return val1 == val2 or (np.isfinite(diff) and
+                            diff <= NNCHAIN_TOL * max(abs(val1), abs(val2)))
+
+
+def nn_chain_merges(matrice):
+    """Find the UPGMA joins with the nearest-neighbor chain algorithm
+
+    The distance between two clusters is the average of the distance of
+    their two parts, as in condense_matrix. A cluster is identified by the
+    smallest index of its leaves. The list of joins (distance, i, j), i > j,
+    is returned in the same order as find_smallest_index would choose them.
+    None is returned if two distances are too close (or equal), since the
+    order of the joins then depends on the index of the nodes.
+    The matrice is not changed. Time is O(n^2).
+    """
+    dist = np.array(matrice, dtype=float)
+    n = dist.shape[0]
+    active = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(np.flatnonzero(active)[0])
+        top = chain[-1]
+        row = np.where(active, dist[top], np.inf)
+        row[top] = np.inf
+        nearest = row.argmin()
+        distance = row[nearest]
+        row[nearest] = np.inf
+        if _near_tie(distance, row.min()):
+            return None
+        if len(chain) > 1 and chain[-2] == nearest:
+            chain = chain[:-2]
+            first, second = max(top, nearest), min(top, nearest)
+            merges.append((distance, first, second))
+            new_vector = (dist[:, first] + dist[:, second]) / 2.0
+            dist[second] = new_vector
+            dist[:, second] = new_vector
+            active[first] = False
+        else:
+            chain.append(nearest)
+
+    merges.sort()
+    for merge_1, merge_2 in zip(merges, merges[1:]):
+        if _near_tie(merge_1[0], merge_2[0]):
+            return None
+    return merges
 
 
 def UPGMA_cluster(matrice, node_order, upgma_depth=None):
@@ -200,6 +704,11 @@ def UPGMA_cluster(matrice, node_order, upgma_depth=None):
     matrice is a np array.
     node_order is a list of TreeClass objects corresponding to the matrice.
 
+    When the whole tree is required, the joins are found with the
+    nearest-neighbor chain algorithm (O(n^2)), then applied in the order of
+    find_smallest_index. The previous O(n^3) algorithm is used
+    when there are ties, or for a partial clustering.
+
     WARNING: Changes matrice in-place.
     before this function is called.
     """
@@ -208,15 +717,27 @@ def UPGMA_cluster(matrice, node_order, upgma_depth=None):
         upgma_depth = num_entries - 1  # default, do all
     tree = None
     smallest_index = []
-    for i in range(upgma_depth):
-        index_1, index_2 = find_smallest_index(matrice)
-        smallest_index = (index_1, index_2)
-        assert(index_1 > index_2)
-        row_order = condense_node_order(
-            matrice, smallest_index, node_order, method='upgma')
-        matrice = condense_matrix(matrice, smallest_index, method='upgma')
-        tree = node_order[smallest_index[1]]
-    return tree, matrice, smallest_index
+    cluster_mat = ClusterMatrix(matrice, labels=node_order)
+    merges = None
+    if upgma_depth == num_entries - 1:
+        merges = nn_chain_merges(cluster_mat.to_array())
+
+    if merges is not None:
+        # the distances are computed again by join, in the same order
+        # as find_smallest_index
+        remaining = np.ones(num_entries, dtype=bool)
+        for distance, first, second in merges:
+            smallest_index = (np.count_nonzero(remaining[:first]),
+                              np.count_nonzero(remaining[:second]))
+            tree = cluster_mat.join(smallest_index, method='upgma')
+            remaining[first] = False
+
+    else:
+        for i in range(upgma_depth):
+            smallest_index = cluster_mat.find_smallest_index()
+            assert(smallest_index[0] > smallest_index[1])
+            tree = cluster_mat.join(smallest_index, method='upgma')
+    return tree, _cluster_result(matrice, cluster_mat, node_order), smallest_index
 
 
 def RAND_cluster(matrice, node_order, rand_depth=None):
@@ -255,59 +776,180 @@ def treeCluster(matrice, node_order, depth=None, method='upgma'):
 
     if(method.lower() == 'nj'):
         return NJ_cluster(matrice, node_order, nj_depth=depth)
+    elif(method.lower() == 'rapidnj'):
+        return RAPIDNJ_cluster(matrice, node_order, rapidnj_depth=depth)
     elif(method.lower() == 'rand'):
         return RAND_cluster(matrice, node_order, rand_depth=depth)
     else:
         return UPGMA_cluster(matrice, node_order, upgma_depth=depth)
 
 
-def distMatProcessor(distances, nFlagVal=1e305, nFlag=False, ignoreNodes=[]):
+def distMatProcessor(distances, nFlagVal=1e305, nFlag=False, ignoreNodes=[], condensed=False, cache=False):
     """Formating distance matrix from a file or string input and node order for
         UPGMA or NJ join
+        If condensed is True, the matrix is returned as a float32
+        CondensedMatrix
+        If cache is True and distances is a file name, the matrix is also
+        saved in a binary file (see convertDistMatrix), which is mapped in
+        memory by the next calls instead of parsing the file again, as long
+        as the file doesn't change. A binary file can also be given directly.
     """
-
-    read_fl = False
-    dist_matrix = []
-    node_order = []
-    matrix = None
-
-    # Read in matrix if file name is given
-    if isinstance(distances, basestring) and os.path.exists(distances):
-        distances = open(distances, 'rU')
-
-    distances = distances.read()
-
-    distances_lines = distances.splitlines()
-    if '<?xml' in distances_lines[0]:
-        # this is an xml file
-        # parse it differently
-        matrix, node_order = parseFastPhyloXml(
-            StringIO(distances), nFlagVal, nFlag)
+    is_file = isinstance(distances, basestring) and os.path.exists(distances)
+    if is_file and distances.endswith(CACHE_EXT):
+        matrix, node_order = loadMatrixCache(distances)
+    elif is_file and cache:
+        matrix, node_order = openMatrixCache(distances, nFlagVal, nFlag)
     else:
-        x_ind = 0
-        for line in distances_lines:
-            line = line.strip()
-            if(line):
-                if not read_fl:
-                    read_fl = True
-                else:
-                    x_ind += 1
-                    line_list = [getFloatValue(
-                        x.strip(), x_ind, y_ind, nFlagVal, nFlag) for y_ind, x in enumerate(line.split())]
-                    dist_matrix.append(line_list[1:])
-                    node_order.append(line_list[0])
-        matrix = np.array(dist_matrix, dtype=np.float)
+        matrix, node_order = readDistMatrix(distances, nFlagVal, nFlag)
 
     if ignoreNodes:
+        # the binary cache is read-only
+        matrix = np.array(matrix)
         for n in ignoreNodes:
             ind = node_order.index(n)
             if ind > -1:
                 matrix = remove_ij(matrix, ind, ind)
                 node_order.remove(n)
 
+    if condensed:
+        matrix = CondensedMatrix(matrix)
     return matrix, node_order
 
 
+def readDistMatrix(distances, nFlagVal=1e305, nFlag=False):
+    """Read a distance matrix from a phylip or fastphylo xml file (name or
+    file object)"""
+    # Read in matrix if file name is given
+    if isinstance(distances, basestring) and os.path.exists(distances):
+        distances = open(distances, 'rU')
+
+    first_line = distances.readline()
+    if '<?xml' in first_line:
+        # this is an xml file
+        # parse it differently, from the beginning
+        distances.seek(0)
+        return parseFastPhyloXml(distances, nFlagVal, nFlag)
+    else:
+        return parsePhylipMatrix(
+            chain([first_line], distances), nFlagVal, nFlag)
+
+
+def fileStamp(filename):
+    """Size and modification time of a file, as a string"""
+    stat = os.stat(filename)
+    return "%i %r" % (stat.st_size, stat.st_mtime)
+
+
+def fileDigest(filename):
+    """sha1 of the content of a file"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def matrixCacheKey(filename, nFlagVal=1e305, nFlag=False, digest=None):
+    """Key of the binary cache of a distance file : the sha1 of the file
+    (digest, computed when it's None) and the options used to read it"""
+    return "%s %r %r" % (digest or fileDigest(filename), nFlagVal, nFlag)
+
+
+def convertDistMatrix(distances, cachefile=None, nFlagVal=1e305, nFlag=False):
+    """Convert a phylip or fastphylo xml distance file into the binary
+    format : a numpy .npy file (cachefile, distances.npy by default)
+    followed by the node order (see saveMatrixCache).
+    Return the name of the binary file"""
+    if cachefile is None:
+        cachefile = distances + CACHE_EXT
+    stamp = fileStamp(distances)
+    matrix, node_order = readDistMatrix(distances, nFlagVal, nFlag)
+    saveMatrixCache(cachefile, matrix, node_order,
+                    matrixCacheKey(distances, nFlagVal, nFlag), stamp)
+    return cachefile
+
+
+def saveMatrixCache(cachefile, matrix, node_order, key='', stamp=''):
+    """Save a distance matrix in the binary format : the matrix in the npy
+    format, then the key, the stamp of the distance file and the node order,
+    one by line, which np.load ignores. The file is written with a temporary
+    name first, so a partial file is never read"""
+    tmpfile = "%s.%i.tmp" % (cachefile, os.getpid())
+    with open(tmpfile, 'wb') as out:
+        np.save(out, np.asarray(matrix, dtype=np.float))
+        out.write("# %s\n# %s\n" % (key, stamp))
+        out.writelines("%s\n" % name for name in node_order)
+    os.rename(tmpfile, cachefile)
+
+
+def readMatrixCacheInfo(cachefile):
+    """Return the key, the stamp and the node order saved after the matrix
+    of a binary distance file"""
+    with open(cachefile, 'rb') as infile:
+        version = np.lib.format.read_magic(infile)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(infile)
+        else:
+            header = np.lib.format.read_array_header_2_0(infile)
+        shape, dtype = header[0], header[2]
+        infile.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+        lines = infile.read().split('\n')[:-1]
+    if len(lines) < 2:
+        raise ValueError("No node order in %s" % cachefile)
+    return lines[0][2:], lines[1][2:], lines[2:]
+
+
+def loadMatrixCache(cachefile, mmap_mode='r'):
+    """Open a binary distance matrix. The matrix is mapped in memory,
+    rows are only read from the disk when they are used"""
+    key, stamp, node_order = readMatrixCacheInfo(cachefile)
+    return np.load(cachefile, mmap_mode=mmap_mode), node_order
+
+
+def openMatrixCache(distances, nFlagVal=1e305, nFlag=False):
+    """Open the binary cache of the distance file distances. The cache is
+    created (or rebuilt when the file has changed) if needed.
+    The distance file is only hashed when it has the same size as when the
+    cache was saved, but not the same modification time"""
+    cachefile = distances + CACHE_EXT
+    stamp = fileStamp(distances)
+    try:
+        key, cached_stamp, node_order = readMatrixCacheInfo(cachefile)
+        digest = key.split(' ', 1)[0]
+        if cached_stamp != stamp:
+            # with the same size, the file may only have been touched
+            same_size = cached_stamp.split()[0] == stamp.split()[0]
+            if not same_size or fileDigest(distances) != digest:
+                digest = None
+        if digest and key == matrixCacheKey(distances, nFlagVal, nFlag, digest):
+            return np.load(cachefile, mmap_mode='r'), node_order
+    except (IOError, ValueError):
+        pass
+
+    matrix, node_order = readDistMatrix(distances, nFlagVal, nFlag)
+    try:
+        saveMatrixCache(cachefile, matrix, node_order,
+                        matrixCacheKey(distances, nFlagVal, nFlag), stamp)
+    except (IOError, OSError):
+        # can't write the cache, use the matrix in memory
+        return matrix, node_order
+    return loadMatrixCache(cachefile)
+
+
+def copyMatrix(matrix):
+    """Return a ClusterMatrix with a copy of matrix, that can be condensed.
+    A matrix mapped from a binary file is mapped again in copy-on-write
+    mode, so only the rows that are changed are copied in memory"""
+    if isinstance(matrix, ClusterMatrix):
+        return matrix.copy()
+    if isinstance(matrix, np.memmap) and matrix.filename and \
+            matrix.flags.c_contiguous:
+        mapped = np.load(matrix.filename, mmap_mode='c')
+        if mapped.shape == matrix.shape:
+            return ClusterMatrix(mapped)
+    return ClusterMatrix(matrix, copy=True)
+
+
 def makeFakeDstMatrice(n, dmin, dmax):
     """Create a fake distance matrice"""
     b = (dmax - dmin) * np.random.random_sample(size=(n, n)) + dmin
@@ -340,24 +982,112 @@ def getFloatValue(number, x_ind, y_ind, nFlagVal, nFlag=False):
         return number
 
 
+def parsePhylipMatrix(lines, nFlagVal, nFlag=False):
+    """Parse a phylip distance matrix : the number of genes on the first
+    line, then one line per gene with its name and its distances.
+
+    The distances of each line are converted at once by numpy, in an array
+    preallocated with the number of genes. Negative distances are replaced
+    by nFlagVal when nFlag is set, and the diagonal is set to 0.
+    """
+    lines = iter(lines)
+    size = 0
+    for line in lines:
+        if line.strip():
+            try:
+                size = int(line.split()[0])
+            except ValueError:
+                pass
+            break
+
+    matrix = np.empty((size, size), dtype=np.float)
+    # only used if the matrix doesn't match the size in the first line
+    dist_matrix = None
+    node_order = []
+    for line in lines:
+        line = line.split()
+        if line:
+            row = np.array(line[1:], dtype=np.float)
+            x_ind = len(node_order)
+            if dist_matrix is None and x_ind < size and row.size == size:
+                matrix[x_ind] = row
+            else:
+                if dist_matrix is None:
+                    dist_matrix = list(matrix[:x_ind])
+                dist_matrix.append(row)
+            node_order.append(line[0])
+
+    if dist_matrix is not None:
+        matrix = np.array(dist_matrix, dtype=np.float)
+    else:
+        matrix = matrix[:len(node_order)]
+    if nFlag:
+        matrix[matrix < 0] = nFlagVal
+    np.fill_diagonal(matrix, 0)
+    return matrix, node_order
+
+
 def parseFastPhyloXml(infile, nFlagVal, nFlag=False):
-    """Parse the fastphylo xml format"""
-    xml = etree.parse(infile)
-    run = xml.find('//run')
-    dimension = int(run.attrib['dim'])
-    identities = run.find('identities')
-    node_order = [i.attrib['name'] for i in identities.iter('identity')]
-    dm = run.find('dms').find('dm')
-    distance_mat = np.zeros(shape=(dimension, dimension), dtype=np.float)
+    """Parse the fastphylo xml format
+
+    The file is read incrementally with iterparse : each row of the first
+    distance matrix of the first run is written in a matrix preallocated
+    with the dimension of the run, then removed from the xml tree. Only the
+    matrix is kept in memory.
+    """
+    options = {}
+    # open elements, to remove the processed ones from their parent (lxml
+    # finds the parent itself)
+    parents = []
+    if hasattr(etree, 'LXML_VERSION'):
+        # only get the useful events, not one per entry
+        options['tag'] = ('run', 'identity', 'dm', 'row')
+        parents = None
+
+    distance_mat = None
+    node_order = []
+    run_count, dm_count = 0, 0
     i = 0
-    for node in dm.iter('row'):
-        j = 0
-        for entry in node.iter('entry'):
-            val = float(entry.text)
-            if(val < 0 and nFlag):
-                val = nFlagVal
-            distance_mat[i, j] = val
-            distance_mat[j, i] = val
-            j += 1
-        i += 1
+    for event, elem in etree.iterparse(infile, events=('start', 'end'), **options):
+        if event == 'start':
+            if parents is not None:
+                parents.append(elem)
+            if elem.tag == 'run':
+                run_count += 1
+                if run_count == 1:
+                    dimension = int(elem.attrib['dim'])
+                    distance_mat = np.zeros(
+                        shape=(dimension, dimension), dtype=np.float)
+            elif elem.tag == 'dm' and run_count == 1:
+                dm_count += 1
+            continue
+
+        if parents is not None:
+            parents.pop()
+        if run_count != 1:
+            continue
+        if elem.tag == 'identity':
+            node_order.append(elem.attrib['name'])
+        elif elem.tag == 'row' and dm_count == 1:
+            row = np.array([entry.text for entry in elem.iter('entry')],
+                           dtype=np.float)
+            distance_mat[i, :row.size] = row
+            distance_mat[:row.size, i] = row
+            i += 1
+        elif elem.tag == 'dm':
+            # only the first distance matrix is used
+            break
+        else:
+            continue
+        # the cleared element and the previous ones are still children of
+        # their parent
+        elem.clear()
+        if parents is None:
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        else:
+            parents[-1].remove(elem)
+
+    if nFlag:
+        distance_mat[distance_mat < 0] = nFlagVal
     return distance_mat, node_order
@@ -0,0 +1,244 @@
+# This file is part of profileNJ
+#
+# SpeciesTreeIndex is the preprocessing of a specietree (euler tour and
+# sparse table for the lca queries, depths, leaf sets and dup/loss costs),
+# built once and shared by all the genetrees reconciled with this specietree
+
+__author__ = "Emmanuel Noutahi"
+
+import hashlib
+import os
+import numpy as np
+import params
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+
+class SpeciesTreeIndex(object):
+    """Integer index of a specietree.
+
+    Nodes are numbered in preorder. The index only contains arrays, names
+    and integers, so it can be pickled and reused with any TreeClass parsed
+    from the same newick (see bind). Indexes are cached in memory, and on
+    disk in `cachedir` when it's set, keyed by the hash of the newick
+    (the topology and the node names). The dup/loss costs of the nodes are
+    compiled for each CostModel used with the index (see costs).
+    """
+
+    cachedir = None
+    # changed with the content of the index, for the indexes saved on disk
+    version = 5
+    # number of indexes kept in memory
+    cachesize = 32
+    _cache = OrderedDict()
+
+    def __init__(self, tree, key=None):
+        self.key = key or self.tree_key(tree)
+        nodes = []
+        parent = []
+        depth = []
+        first = []
+        euler = []
+        ids = {}
+        for postorder, node in tree.iter_prepostorder():
+            if not postorder:
+                ids[node] = len(nodes)
+                parent.append(ids[node.up] if node is not tree else -1)
+                depth.append(depth[parent[-1]] + 1 if node is not tree else 0)
+                first.append(len(euler))
+                euler.append(ids[node])
+                nodes.append(node)
+            if (postorder or node.is_leaf()) and node is not tree:
+                # going back to the parent
+                euler.append(ids[node.up])
+
+        self.names = [node.name for node in nodes]
+        self.name2id = dict((name, i) for i, name in enumerate(self.names))
+        self.parent = np.array(parent, dtype=int)
+        self.depths = np.array(depth, dtype=int)
+        self.first = np.array(first, dtype=int)
+        self.euler = np.array(euler, dtype=int)
+        self.rmq = self._sparse_table(self.depths[self.euler])
+
+        # leaf sets as bitsets, leaves are numbered in preorder
+        self.leaves = [i for i, node in enumerate(nodes) if node.is_leaf()]
+        self.leafnames = [self.names[i] for i in self.leaves]
+        self.leafbit = dict((name, 1 << rank)
+                            for rank, name in enumerate(self.leafnames))
+        self.leafset = [0] * len(nodes)
+        for rank, i in enumerate(self.leaves):
+            self.leafset[i] = 1 << rank
+        for i in xrange(len(nodes) - 1, 0, -1):
+            self.leafset[parent[i]] |= self.leafset[i]
+
+        # children of each node, sorted by (parent, id), see child_toward
+        n = len(nodes)
+        kids = np.arange(1, n)
+        kidkey = self.parent[1:] * n + kids
+        order = np.argsort(kidkey)
+        self.kids, self.kidkey = kids[order], kidkey[order]
+        self.unitedge, self.unitprefix = self.loss_prefix(np.ones(n))
+        self._costs = {}
+
+    @staticmethod
+    def _sparse_table(euler_depth):
+        """rmq[i, j] is the position of the minimum depth in
+        euler_depth[i:i+2**j]"""
+        n = len(euler_depth)
+        rmq = np.zeros((n, n.bit_length()), dtype=int)
+        rmq[:, 0] = np.arange(n)
+        for j in xrange(1, n.bit_length()):
+            half = 2**(j - 1)
+            left = rmq[:n - 2**j + 1, j - 1]
+            right = rmq[half:half + len(left), j - 1]
+            rmq[:len(left), j] = np.where(
+                euler_depth[left] < euler_depth[right], left, right)
+        return rmq
+
+    def loss_prefix(self, losscost):
+        """Return the loss cost of the edge above each node (the cost of its
+        siblings, lost when a gene goes through this edge) and the sums of
+        these costs on the path from the root to each node"""
+        childsum = np.bincount(self.parent[1:], weights=losscost[1:],
+                               minlength=len(self.names))
+        edge = np.zeros(len(self.names))
+        edge[1:] = childsum[self.parent[1:]] - losscost[1:]
+        # parents come before their children in preorder
+        prefix = edge.copy()
+        for i, p in enumerate(self.parent.tolist()):
+            if p >= 0:
+                prefix[i] += prefix[p]
+        return edge, prefix
+
+    def leaf_range(self, i):
+        """Return the interval of the ranks of the leaves under the node i
+        (leaves are ranked in preorder, so they are contiguous)"""
+        leafset = self.leafset[i]
+        return (leafset & -leafset).bit_length() - 1, leafset.bit_length()
+
+    def species_bits(self, species):
+        """Return the leaf set (bitset) of a list of specietree node names"""
+        bits = 0
+        for name in species:
+            try:
+                bits |= self.leafset[self.name2id[name]]
+            except KeyError:
+                raise ValueError("Specie %s not found in the specietree" % name)
+        return bits
+
+    def leaf_names(self, leafset):
+        """Return the names of the leaves of a leaf set (bitset), in
+        preorder"""
+        names = []
+        while leafset:
+            low = leafset & -leafset
+            names.append(self.leafnames[low.bit_length() - 1])
+            leafset ^= low
+        return names
+
+    def child_toward(self, anc, desc):
+        """Return the child of each node of anc that is an ancestor of (or
+        is) the node of desc at the same position (arrays of ids)"""
+        pos = np.searchsorted(self.kidkey, np.asarray(anc) * len(self.names) +
+                              desc, side='right') - 1
+        return self.kids[pos]
+
+    def costs(self, costs=None):
+        """Return the dup cost and the loss cost of each node, and the loss
+        cost of the edges and their root path sums (see loss_prefix), with
+        the costs of a CostModel (params.default when it's None)"""
+        costs = params.get_model(costs)
+        table = self._costs.get(costs.key)
+        if table is None:
+            names = [None] * len(self.names)
+            for i in self.leaves:
+                names[i] = self.names[i]
+            dup, loss = costs.compile_index(names, self.parent.tolist())
+            table = (dup, loss) + self.loss_prefix(loss)
+            self._costs[costs.key] = table
+        return table
+
+    @staticmethod
+    def tree_key(tree):
+        """Hash of the tree topology and node names"""
+        return hashlib.sha1(tree.write(format=8, format_root_node=True) +
+                            repr(SpeciesTreeIndex.version)).hexdigest()
+
+    @classmethod
+    def get(cls, tree):
+        """Return the index of tree, from the cache if the same tree was
+        already indexed, and bind it to the nodes of tree"""
+        key = cls.tree_key(tree)
+        index = cls._cache.pop(key, None)
+        cachefile = None
+        if index is None and cls.cachedir:
+            cachefile = os.path.join(cls.cachedir, key + '.pkl')
+            index = cls.load(cachefile)
+        if index is None:
+            index = cls(tree, key)
+            if cachefile:
+                index.save(cachefile)
+        cls._cache[key] = index
+        if len(cls._cache) > cls.cachesize:
+            cls._cache.popitem(last=False)
+        # a copy of the tree also has the lcaindex feature
+        if getattr(tree, 'lcaindex', None) is not index or \
+                tree.id2node[0] is not tree:
+            index.bind(tree)
+        return index
+
+    @staticmethod
+    def load(cachefile):
+        """Load a pickled index, return None if it can't be read. A file
+        that is not a pickled index is removed (get saves it again)"""
+        if not os.path.exists(cachefile):
+            return None
+        try:
+            with open(cachefile, 'rb') as infile:
+                index = pickle.load(infile)
+            if isinstance(index, SpeciesTreeIndex):
+                return index
+        except Exception:
+            pass
+        try:
+            os.remove(cachefile)
+        except OSError:
+            pass
+        return None
+
+    def save(self, cachefile):
+        """Pickle the index, the file is replaced only when complete"""
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as outfile:
+                pickle.dump(self, outfile, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, cachefile)
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def bind(self, tree):
+        """Set the lcaid and depth features of the nodes of tree (parsed from
+        the indexed newick) and return the list of nodes by id"""
+        nodes = list(tree.traverse("preorder"))
+        if len(nodes) != len(self.names):
+            raise ValueError("Tree does not match the specietree index")
+        for i, depth in enumerate(self.depths.tolist()):
+            nodes[i].add_features(lcaid=i, depth=depth)
+        tree.add_features(lcaprocess=True, lcaindex=self, id2node=nodes)
+        return nodes
+
+    def lca(self, i, j):
+        """Batched lca queries : return the id of the lca of the nodes at
+        positions i and j of the euler tour (arrays of positions)"""
+        i, j = np.asarray(i, dtype=int), np.asarray(j, dtype=int)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        # k = floor(log2(j - i + 1)), exactly
+        k = np.frexp(j - i + 1)[1] - 1
+        left = self.euler[self.rmq[i, k]]
+        right = self.euler[self.rmq[j - (1 << k) + 1, k]]
+        return np.where(self.depths[left] <= self.depths[right], left, right)
@@ -11,7 +11,9 @@ from ete3.phylo import EvolEvent
 import types
 from collections import defaultdict as ddict
 from itertools import izip
+from operator import attrgetter
 import copy
+import hashlib
 
 try:
     import cPickle as pickle
@@ -38,6 +40,50 @@ class TreeClass(TreeNode):
     def __repr__(self):
         return "Tree Class '%s' (%s)" % (self.name, hex(self.__hash__()))
 
+    # Changing the parent, the children or the name of a node clears the
+    # structural hash and the species bitsets of this node and of its
+    # ancestors (see structural_hash and set_species_bits)
+    def _set_up(self, value):
+        _clear_caches(self._up)
+        TreeNode._set_up(self, value)
+        _clear_caches(value)
+
+    def _set_children(self, value):
+        TreeNode._set_children(self, value)
+        _clear_caches(self)
+
+    def _set_name(self, value):
+        self._name = value
+        _clear_caches(self)
+
+    up = property(fget=TreeNode._get_up, fset=_set_up)
+    children = property(fget=TreeNode._get_children, fset=_set_children)
+    name = property(fget=attrgetter('_name'), fset=_set_name)
+
+    def structural_hash(self):
+        """Return a hash of the topology and of the leaf names under this node,
+        that does not depend on the order of the children. The hash of each
+        node is computed from the hash of its children and kept until the
+        subtree is changed"""
+        if '_shash' not in self.__dict__:
+            for node in self.traverse("postorder", is_leaf_fn=_has_structural_hash):
+                if '_shash' in node.__dict__:
+                    continue
+                if node.is_leaf():
+                    content = "0" + str(node.name)
+                else:
+                    content = "1" + "".join(sorted(child._shash for child in node.children))
+                node._shash = hashlib.sha1(content).digest()
+        return self._shash
+
+    def __getstate__(self):
+        """The species bitsets are not pickled with the node, they would
+        need the specietree index"""
+        state = self.__dict__.copy()
+        state.pop('_spbits', None)
+        state.pop('_spindex', None)
+        return state
+
     def get_child_at(self, i=0):
         """Return child at a specific position in the children list of a node"""
         children_list = self.get_children()
@@ -541,7 +587,6 @@ class TreeClass(TreeNode):
         events detected after this node.
         """
         all_events = []
-        root = self.copy()
         assert self.is_reconcilied(), "Your tree is not reconciled!"
         for node in self.traverse("levelorder"):
             e = EvolEvent()
@@ -611,10 +656,42 @@ class TreeClass(TreeNode):
         """ Returns True if species names under this node are all
         included in a given list or set of species names."""
 
+        index = self.get_tree_root().__dict__.get('_spindex')
+        spbits = self.get_species_bits()
+        if spbits is not None and index is not None:
+            bits = 0
+            for specie in specieSet:
+                bits |= index.leafbit.get(specie, 0)
+            return not spbits & ~bits
+
         if type(specieSet) != set:
             specieSet = set(specieSet)
         return self.get_leaf_species().issubset(specieSet)
 
+    def set_species_bits(self, index):
+        """Set the species bitset of each node under this node : the leaf set
+        (bitset) of the species of its leaves in the specietree index, computed
+        in one postorder traversal. The bitsets are only set when all of them
+        are computed, and are cleared when the subtree is changed (see
+        get_species_bits)"""
+        node_bits = {}
+        for node in self.traverse("postorder"):
+            if node.is_leaf():
+                bits = index.species_bits(node.species.split(","))
+            else:
+                bits = 0
+                for child in node.children:
+                    bits |= node_bits[child]
+            node_bits[node] = bits
+        for node, bits in node_bits.iteritems():
+            node._spbits = bits
+        self._spindex = index
+
+    def get_species_bits(self):
+        """Return the species bitset of this node set by set_species_bits,
+        or None"""
+        return self.__dict__.get('_spbits')
+
     def has_polytomies(self):
         """Return whether or not this tree has polytomies
         """
@@ -729,8 +806,15 @@ class TreeClass(TreeNode):
         """
         assert(not self.is_leaf() and self.is_binary() and (
             self.type > 0 or self.has_feature('dup', True)))  # self should be a duplication node
-        r_child_spec_set = self.get_child_at(0).get_leaf_species()
-        l_child_spec_set = self.get_child_at(1).get_leaf_species()
+        r_child, l_child = self.get_child_at(0), self.get_child_at(1)
+        r_bits, l_bits = r_child.get_species_bits(), l_child.get_species_bits()
+        if r_bits is not None and l_bits is not None:
+            inter = bin(r_bits & l_bits).count("1")
+            union = bin(r_bits | l_bits).count("1")
+            self.add_feature('dupcons', inter / union)
+            return self.dupcons
+        r_child_spec_set = r_child.get_leaf_species()
+        l_child_spec_set = l_child.get_leaf_species()
         inter_set = r_child_spec_set.intersection(l_child_spec_set)
         union_set = r_child_spec_set.union(l_child_spec_set)
         self.add_feature('dupcons', len(inter_set) / len(union_set))
@@ -828,3 +912,30 @@ class TreeClass(TreeNode):
     @staticmethod
     def _capitalize(line):
         return "".join([line[0].upper(), line[1:]])
+
+
+def _has_structural_hash(node):
+    return '_shash' in node.__dict__
+
+
+def _clear_structural_hash(node):
+    """Clear the structural hash of node and of its ancestors. The hashes
+    are computed bottom-up, so the ancestors of a node without hash don't
+    have one"""
+    while node is not None and node.__dict__.pop('_shash', None) is not None:
+        node = node._up
+
+
+def _clear_species_bits(node):
+    """Clear the species bitsets of node and of its ancestors, and the index
+    set on the root by set_species_bits"""
+    while node is not None and node.__dict__.pop('_spbits', None) is not None:
+        node.__dict__.pop('_spindex', None)
+        node = node._up
+
+
+def _clear_caches(node):
+    """Clear the values computed from the subtree of node and of its
+    ancestors"""
+    _clear_structural_hash(node)
+    _clear_species_bits(node)
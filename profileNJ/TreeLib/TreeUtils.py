@@ -16,7 +16,9 @@ import sys
 import urllib2
 import numpy as np
 from TreeClass import TreeClass
+from SpeciesTreeIndex import SpeciesTreeIndex
 from collections import defaultdict as ddict
+from itertools import izip
 from ete3 import Phyloxml
 from ete3 import orthoxml
 from ete3.parser.newick import NewickError
@@ -90,118 +92,124 @@ def fetch_ensembl_genetree_by_member(memberID=None, species=None, id_type=None,
 
 
 def lcaPreprocess(tree):
-    """Make an euler tour of this tree"""
-    # root = tree.get_tree_root()
-    tree.add_features(depth=0)
-    tree.del_feature('euler_visit')
-    for node in tree.iter_descendants("levelorder"):
-        node.del_feature('euler_visit')
-        # can write this because parent are always visited before
-        node.add_features(depth=node.up.depth + 1)
-    node_visited = tree._euler_visit([])
-    # print tree.get_ascii(show_internal= True, attributes=['name', 'euler_visit', 'depth'])
-    # number of element in array
-    n = len(node_visited)
-    m = int(np.ceil(np.log2(n)))
-    rmq_array = np.zeros((n, m), dtype=int)
-    for i in xrange(n):
-        rmq_array[i, 0] = i
-    for j in xrange(1, m):
-        i = 0
-        while(i + 2**j < n - 1):
-            if(node_visited[rmq_array[i, j - 1]].depth < node_visited[rmq_array[(i + 2**(j - 1)), j - 1]].depth):
-                rmq_array[i, j] = rmq_array[i, j - 1]
-            else:
-                rmq_array[i, j] = rmq_array[i + 2**(j - 1), j - 1]
-            i += 1
-
-    node_map = ddict()
-    name2ind = ddict()
-    for i in xrange(n):
-        cur_node = node_visited[i]
-        # bad practice
-        try:
-            node_map[cur_node] = min(node_map[cur_node], i)
-        except:
-            node_map[cur_node] = i
-        name2ind[cur_node.name] = node_map[cur_node]
-
-    tree.add_features(lcaprocess=True)
-    tree.add_features(rmqmat=rmq_array)
-    tree.add_features(ind2node=node_visited)
-    tree.add_features(node2ind=node_map)
-    tree.add_features(name2ind=name2ind)
+    """Make an euler tour of this tree and build the sparse table used to
+    answer the lca queries (see SpeciesTreeIndex)
+
+    Each node get its depth and its index (lcaid, in preorder) as features.
+    The index is set as the lcaindex feature of the tree, and the list of
+    nodes by lcaid as its id2node feature.
+    """
+    return SpeciesTreeIndex.get(tree)
 
 
 def getLca(sptree, species):
     """This should be a faster lcamapping
-    species should be a list of node"""
+    species should be a list of node (or of leaf names)"""
     if not sptree.has_feature('lcaprocess', True):
         lcaPreprocess(sptree)
-    A = sptree.ind2node
-    M = sptree.rmqmat
+    index = sptree.lcaindex
+    ind = [index.first[index.name2id[spec] if isinstance(spec, basestring)
+                       else spec.lcaid] for spec in species]
     # using the biggest interval should return the lca of all species
-    if len(species) > 1:
-        s_index = sorted([sptree.node2ind[spec] for spec in species])
-    # print "s_index vaut :", s_index , " et taille est : ", len(sptree.node2ind), " et rmq est : ", sptree.rmqmat.shape
-    # print sptree.ind2node
-        i = s_index[0]
-        j = s_index[-1]
+    return sptree.id2node[int(index.lca(min(ind), max(ind)))]
 
-    else:
-        if isinstance(species[0], str):
-            # in this case, we have a leaf
-            i = sptree.name2ind[species[0]]
-        else:
-            # this is an instance of TreeClass
-            i = sptree.node2ind[species[0]]
-        j = i
-    k = int(np.log2(j - i + 1))
-    if (A[M[i, k]].depth <= A[M[j - 2**(k) + 1, k]].depth):
-        return A[M[i, k]]
-    else:
-        return A[M[j - 2**(k) + 1, k]]
 
+def lcaQuery(sptree, i, j):
+    """Batched lca queries : return the lcaid of the lca of the nodes at
+    positions i and j of the euler tour of sptree (arrays of positions)"""
+    if not sptree.has_feature('lcaprocess', True):
+        lcaPreprocess(sptree)
+    return sptree.lcaindex.lca(i, j)
 
-def lcaMapping(genetree, specietree, multspeciename=True):
+
+def lcaMapping(genetree, specietree, multspeciename=True, asarray=False):
     """LCA mapping between a genetree and a specietree
     :argument genetree: your genetree, All leave in the genetree should already have feature 'specie' (set_specie was called)
     :argument specietree: your specietree
     :argument multspeciename: A flag to use in order to accept multi specie name at genetree internal node.
+    :argument asarray: Return the mapping as an integer array instead of a dict : the lcaid of the specietree node of each genetree node, in postorder. In that case, the species features and the lcaMap feature are not set (see setSpeciesFeatures).
     """
 
-    smap = {}  # a dict that map specie name to specie node in specietree
-    mapping = {}
     if not specietree.has_feature('lcaprocess', True):
         lcaPreprocess(specietree)
+    index = specietree.lcaindex
+
+    # The genetree nodes are grouped by height, so all the nodes of a level
+    # are mapped with one batch of queries, once their children are mapped
+    nodes, parent = getPostorderIndex(genetree)
+    height = [0] * len(nodes)
+    levels = ddict(lambda: ([], [], []))
+    lca = np.empty(len(nodes), dtype=int)
+    children = ddict(list)
+    for i, p in enumerate(parent.tolist()):
+        if i not in children:
+            lca[i] = index.name2id[nodes[i].species]
+        else:
+            height[i] = max([height[c] for c in children[i]]) + 1
+            level_nodes, level_children, starts = levels[height[i]]
+            level_nodes.append(i)
+            starts.append(len(level_children))
+            level_children.extend(children[i])
+        children[p].append(i)
+
+    for h in xrange(1, len(levels) + 1):
+        level_nodes, level_children, starts = levels[h]
+        pos = index.first[lca[level_children]]
+        lca[level_nodes] = index.lca(np.minimum.reduceat(
+            pos, starts), np.maximum.reduceat(pos, starts))
+
+    if asarray:
+        return lca
+    mapping = dict(zip(nodes, [specietree.id2node[s] for s in lca.tolist()]))
+    __set_species_features(nodes, parent, index.names, lca, multspeciename)
+    genetree.add_features(lcaMap=mapping)
+    return mapping
 
-    for node in genetree.traverse(strategy="postorder"):
 
-        if node.is_leaf():
-            mapping[node] = getLca(specietree, [node.species])
-        else:
-            # ML ADDED THIS
-            species = list(set([mapping[n] for n in node.get_children()]))
-            mapping[node] = getLca(specietree, species)
+def getPostorderIndex(genetree):
+    """Return the list of the nodes of genetree in postorder, and the array
+    of the position of their parent in this list (-1 for the root)"""
+    nodes = list(genetree.traverse(strategy="postorder"))
+    node_ind = dict((node, i) for i, node in enumerate(nodes))
+    parent = np.array([node_ind.get(node.up, -1) for node in nodes], dtype=int)
+    return nodes, parent
+
+
+def setSpeciesFeatures(genetree, specietree, lcamap, multspeciename=True):
+    """Set the species feature of the internal nodes of genetree from an
+    integer lca mapping (see lcaMapping with asarray)"""
+    nodes, parent = getPostorderIndex(genetree)
+    __set_species_features(nodes, parent, specietree.lcaindex.names, lcamap,
+                           multspeciename)
+
+
+def __set_species_features(nodes, parent, names, lcamap, multspeciename):
+    lcamap = lcamap.tolist()
+    species = ddict(set)
+    for i, p in enumerate(parent.tolist()):
+        if i in species:
             if(multspeciename):
-                node.add_features(
-                    species=",".join(sorted([x.name for x in species])))
+                nodes[i].add_features(
+                    species=",".join(sorted([names[s] for s in species[i]])))
             else:
-                node.add_features(species=mapping[node].name)
-
-    genetree.add_features(lcaMap=mapping)
-    return mapping
+                nodes[i].add_features(species=names[lcamap[i]])
+        species[p].add(lcamap[i])
 
 
-def reconcile(genetree=None, lcaMap=None, lost=False, lost_label_fn=None):
+def reconcile(genetree=None, lcaMap=None, lost=False, lost_label_fn=None, specietree=None):
     """Reconcile genetree topology to a specietree, using an adequate mapping obtained with lcaMapping.
     'reconcile' will infer evolutionary events like gene lost, gene speciation and gene duplication with distinction between AD and NAD
+    The specietree is required when lcaMap is an integer array (lcaMapping with asarray)
     """
 
     if(lcaMap is None or genetree is None):
         raise Exception("lcaMapping or genetree not found")
     else:
-        lost_count = 1
+        if isinstance(lcaMap, np.ndarray):
+            # the NAD test needs the species features of the internal nodes
+            setSpeciesFeatures(genetree, specietree, lcaMap)
+            lcaMap = dict(zip(genetree.traverse("postorder"),
+                              [specietree.id2node[s] for s in lcaMap.tolist()]))
         for node in genetree.traverse("levelorder"):
             node.add_features(type=TreeClass.SPEC)
             node.add_features(dup=False)
@@ -218,135 +226,143 @@ def reconcile(genetree=None, lcaMap=None, lost=False, lost_label_fn=None):
                     node.type = TreeClass.NAD
 
         if (isinstance(lost, basestring) and lost.upper() == "YES") or lost:
-            for node in genetree.traverse("postorder"):
-                children_list = node.get_children()
-                node_is_dup = (
-                    node.type == TreeClass.NAD or node.type == TreeClass.AD)
-                for child_c in children_list:
-                    if((node_is_dup and lcaMap[child_c] != lcaMap[node]) or (not node_is_dup and (lcaMap[child_c].up != lcaMap[node]))):
-
-                        while((lcaMap[child_c].up != lcaMap[node] and node.type == TreeClass.SPEC) or (lcaMap[child_c] != lcaMap[node] and node.type != TreeClass.SPEC)):
-                            lostnode = TreeClass()
-                            intern_lost = TreeClass()
-                            intern_lost.add_features(type=TreeClass.SPEC)
-                            intern_lost.add_features(dup=False)
-
-                            if lcaMap[child_c].is_root():
-                                intern_lost.species = ",".join(
-                                    lcaMap[child_c].get_leaf_names())
-                                lcaMap.update({intern_lost: lcaMap[child_c]})
-
-                            else:
-                                intern_lost.species = ",".join(
-                                    lcaMap[child_c].up.get_leaf_names())
-                                lcaMap.update(
-                                    {intern_lost: lcaMap[child_c].up})
-
-                            # change here to display a subtree and not a leaf
-                            # with a lot of specie
-                            lostnode.species = ",".join(
-                                set(lcaMap[intern_lost].get_leaf_names()) - set(lcaMap[child_c].get_leaf_names()))
-                            splist = lostnode.species.split(',')
-                            if(len(splist) > 1):
-                                if lost_label_fn:
-                                    lostnode.name = lost_label_fn(splist)
-                                else:
-                                    lostnode.name = "lost_" + \
-                                        str(lost_count) + "_" + \
-                                        "|".join([s[0:3] for s in splist])
-
-                            else:
-                                if lost_label_fn:
-                                    lostnode.name = lost_label_fn(
-                                        lostnode.species)
-                                else:
-                                    lostnode.name = "lost_" + lostnode.species
-
-                            lostnode.add_features(type=TreeClass.LOST)
-                            lostnode.add_features(dup=False)
-
-                            lost_count += 1
-                            child_c.detach()
-                            # print "***********************\n\n** node : ", node, "\n\n** child_c: ", child_c, "\n\n** child parent", child_c.up
-                            # node.remove_child(child_c)
-                            intern_lost.add_child(child=lostnode)
-                            intern_lost.add_child(child=child_c)
-                            child_c = intern_lost
-                        node.add_child(child_c)
-                        children_list.append(child_c)
-
-                # Case of polytomie in species tree....
-                if not node.is_leaf():
-                    specie_list = ",".join(
-                        [",".join(lcaMap[child_c].get_leaf_names()) for child_c in node.get_children()])
-                    child_specie_set = set(specie_list.split(","))
-                    real_specie_list = set(lcaMap[node].get_leaf_names())
-                    unadded_specie = real_specie_list - child_specie_set
-                    # print unadded_specie, child_specie_set, real_specie_list
-                    # print node.species
-                    if(unadded_specie):
-                        lostnode = TreeClass()
-                        lostnode.add_features(type=TreeClass.LOST)
-                        lostnode.add_features(dup=False)
-                        lostnode.species = ",".join(unadded_specie)
-
-                        if(len(unadded_specie) > 1):
-                            lostnode.name = "lost_" + \
-                                str(lost_count) + "_" + \
-                                "|".join([s[0:3] for s in unadded_specie])
-
-                        else:
-                            lostnode.name = "lost_" + lostnode.species
-
-                        lost_count += 1
-                        node.add_child(lostnode)
+            __insert_losses(genetree, lcaMap, lost_label_fn)
+        sptree = lcaMap[genetree].get_tree_root()
+        if sptree.has_feature('lcaprocess', True):
+            # species sets as bitsets, for compute_dup_cons
+            try:
+                genetree.set_species_bits(sptree.lcaindex)
+            except ValueError:
+                pass
     genetree.add_features(reconciled=True)
 
 
-def computeDLScore(genetree, lcaMap=None, dupcost=None, losscost=None):
-    """
-    Compute the reconciliation cost
-    """
-    if not lcaMap and genetree.has_feature('lcaMap'):
-        lcaMap = genetree.lcaMap
-    dup_score = 0
-    loss_score = 0
-    if lcaMap:
-        for node in genetree.traverse("levelorder"):
-            node_is_dup = 0
-            child_map = [lcaMap[child] for child in node.get_children()]
-            if (lcaMap[node] in child_map):
-                node_is_dup = params.getdup(lcaMap[node])
-                dup_score += (dupcost if dupcost else node_is_dup)
-
-            for child in node.get_children():
-                if node_is_dup:
-                    child_map = [lcaMap[node]]
+def __insert_losses(genetree, lcaMap, lost_label_fn=None):
+    """Insert the lost nodes in a genetree labeled by reconcile, in one
+    postorder pass. The leaves under each specietree node are an interval of
+    the leaves of the specietree index, and the lost species of a polytomy
+    of the specietree are found with the leaf sets (bitsets) of the index"""
+    sptree = lcaMap[genetree].get_tree_root()
+    if not sptree.has_feature('lcaprocess', True):
+        lcaPreprocess(sptree)
+    index = sptree.lcaindex
+    sp_parent = index.parent.tolist()
+    leafnames = index.leafnames
+    img = dict((node, s.lcaid) for node, s in lcaMap.items())
+    species = {}
+    lost_count = 1
+
+    def species_of(s):
+        if s not in species:
+            lo, hi = index.leaf_range(s)
+            species[s] = ",".join(leafnames[lo:hi])
+        return species[s]
+
+    for node in list(genetree.traverse("postorder")):
+        node_is_dup = (node.type == TreeClass.NAD or node.type == TreeClass.AD)
+        m = img[node]
+        for child_c in node.get_children():
+            s = img[child_c]
+            if (s == m) if node_is_dup else (sp_parent[s] == m):
+                continue
+            top = child_c
+            child_c.detach()
+            while (s != m) if node_is_dup else (sp_parent[s] != m):
+                # the species of the other children of the parent of s are lost
+                p = sp_parent[s] if sp_parent[s] >= 0 else s
+                intern_lost = TreeClass()
+                intern_lost.add_features(type=TreeClass.SPEC)
+                intern_lost.add_features(dup=False)
+                intern_lost.species = species_of(p)
+                lcaMap[intern_lost] = sptree.id2node[p]
+                img[intern_lost] = p
+
+                lo, hi = index.leaf_range(p)
+                c_lo, c_hi = index.leaf_range(s)
+                splist = leafnames[lo:c_lo] + leafnames[c_hi:hi]
+                lostnode = TreeClass()
+                lostnode.species = ",".join(splist)
+                if(len(splist) > 1):
+                    if lost_label_fn:
+                        lostnode.name = lost_label_fn(splist)
+                    else:
+                        lostnode.name = "lost_" + str(lost_count) + "_" + \
+                            "|".join([sp[0:3] for sp in splist])
                 else:
-                    child_map = lcaMap[node].get_children()
-                curr_node = lcaMap[child]
-                while(curr_node not in child_map):
-                    lost_nodes = set(
-                        curr_node.up.get_children()) - set([curr_node])
-                    if losscost:
-                        loss_score += len(lost_nodes) * losscost
+                    if lost_label_fn:
+                        lostnode.name = lost_label_fn(lostnode.species)
                     else:
-                        loss_score += np.sum([params.getloss(l)
-                                              for l in lost_nodes])
-                    curr_node = curr_node.up
+                        lostnode.name = "lost_" + lostnode.species
+                lostnode.add_features(type=TreeClass.LOST)
+                lostnode.add_features(dup=False)
+
+                lost_count += 1
+                intern_lost.add_child(child=lostnode)
+                intern_lost.add_child(child=top)
+                top = intern_lost
+                s = p
+            node.add_child(top)
+
+        # Case of polytomie in species tree....
+        if not node.is_leaf():
+            covered = 0
+            for child_c in node.get_children():
+                covered |= index.leafset[img[child_c]]
+            unadded_specie = index.leaf_names(index.leafset[m] & ~covered)
+            if(unadded_specie):
+                lostnode = TreeClass()
+                lostnode.add_features(type=TreeClass.LOST)
+                lostnode.add_features(dup=False)
+                lostnode.species = ",".join(unadded_specie)
+
+                if(len(unadded_specie) > 1):
+                    lostnode.name = "lost_" + \
+                        str(lost_count) + "_" + \
+                        "|".join([sp[0:3] for sp in unadded_specie])
+                else:
+                    lostnode.name = "lost_" + lostnode.species
 
-    else:
-        raise Exception("LcaMapping not provided !!")
-    return dup_score, loss_score
+                lost_count += 1
+                node.add_child(lostnode)
 
 
-def computeDL(genetree, lcaMap=None):
+def computeDLScore(genetree, lcaMap=None, dupcost=None, losscost=None, specietree=None, costs=None):
+    """
+    Compute the reconciliation cost
+    The specietree is required when lcaMap is an integer array (lcaMapping with asarray)
+    The per species costs are read from the CostModel costs (params.default when it's None)
+    """
+    if not isinstance(lcaMap, np.ndarray):
+        if not lcaMap and genetree.has_feature('lcaMap'):
+            lcaMap = genetree.lcaMap
+        if not lcaMap:
+            raise Exception("LcaMapping not provided !!")
+        specietree = lcaMap[genetree].get_tree_root()
+        lcaMap = np.array([lcaMap[node].lcaid
+                           for node in genetree.traverse("postorder")], dtype=int)
+    return __array_dl_score(genetree, lcaMap, specietree, dupcost, losscost, costs)
+
+
+def computeDL(genetree, lcaMap=None, specietree=None):
     """
     Compute the number of duplication and the number of losses
+    The specietree is required when lcaMap is an integer array (lcaMapping with asarray)
     """
     loss = 0
     dup = 0
 
+    if isinstance(lcaMap, np.ndarray):
+        if not genetree.is_reconcilied():
+            nodes, parent = getPostorderIndex(genetree)
+            child = np.flatnonzero(parent >= 0)
+            is_dup = __array_dup(lcaMap, parent, child)
+            depth = specietree.lcaindex.depths[lcaMap]
+            loss = depth[child] - depth[parent[child]] - \
+                1 + is_dup[parent[child]]
+            return int(is_dup.sum()), int(loss.sum())
+        # the events are counted on the reconciled genetree
+        lcaMap = None
+
     if not lcaMap and genetree.has_feature('lcaMap'):
         lcaMap = genetree.lcaMap
 
@@ -377,6 +393,59 @@ def computeDL(genetree, lcaMap=None):
     return dup, loss
 
 
+def __array_dup(lcamap, parent, child):
+    """Duplication flag of each genetree node (postorder), from an integer
+    lca mapping : one of its children has the same image"""
+    is_dup = np.zeros(len(lcamap), dtype=int)
+    is_dup[parent[child][lcamap[child] == lcamap[parent[child]]]] = 1
+    return is_dup
+
+
+def __array_dl_score(genetree, lcamap, specietree, dupcost=None, losscost=None, costs=None):
+    """computeDLScore with an integer lca mapping, in one pass over the
+    genetree edges : the loss cost of an edge is a difference of the root
+    path sums of the specietree index (see SpeciesTreeIndex.loss_prefix)"""
+    if not specietree.has_feature('lcaprocess', True):
+        lcaPreprocess(specietree)
+    index = specietree.lcaindex
+    spdup, sploss, lossedge, lossprefix = index.costs(costs)
+    nodes, parent = getPostorderIndex(genetree)
+    child = np.flatnonzero(parent >= 0)
+    is_dup = __array_dup(lcamap, parent, child)
+    dup_nodes = np.flatnonzero(is_dup)
+    if dupcost:
+        dup_score = len(dup_nodes) * dupcost
+    else:
+        dup_score = spdup[lcamap[dup_nodes]].sum()
+
+    edge, prefix = lossedge, lossprefix
+    if losscost:
+        edge, prefix = index.unitedge, index.unitprefix
+    img, up = lcamap[child], lcamap[parent[child]]
+    # losses on the path from the image of a child to the image of its
+    # parent, excluding the edge under the parent image for a speciation
+    loss = prefix[img] - prefix[up]
+    spec = is_dup[parent[child]] == 0
+    loss[spec] -= edge[index.child_toward(up[spec], img[spec])]
+    loss_score = loss.sum()
+    if losscost:
+        loss_score = int(round(loss_score)) * losscost
+    # the scores have the type of the costs, as sums of python numbers
+    model = params.get_model(costs)
+    dup_float = isinstance(dupcost, float) if dupcost else model.float_costs("dup")
+    loss_float = isinstance(losscost, float) if losscost else model.float_costs()
+    return __py_number(dup_score, dup_float), __py_number(loss_score, loss_float)
+
+
+def __py_number(x, is_float):
+    """Python number of the numpy scalar x, a float when is_float is True,
+    else an int (x is then a sum of int costs)"""
+    x = np.asarray(x).item()
+    if is_float:
+        return float(x)
+    return int(round(x))
+
+
 def cleanFeatures(tree=None, features=[]):
     cleaned = False
     if(tree):
@@ -393,6 +462,21 @@ def __is_dist_elligible(tree):
     return not (all([n.dist == 1.0 for n in tree.iter_descendants()]) and tree.dist == 0)
 
 
+def __path_sums(node, start):
+    """start plus the branch lengths from each leaf of node up to node,
+    added one by one from the leaf, as TreeNode.get_distance does.
+    One row by leaf of node, in traversal order"""
+    sums = {}
+    for n in node.traverse("postorder"):
+        if n.is_leaf():
+            path = start[np.newaxis] + n.dist
+        else:
+            path = np.concatenate([sums.pop(c) for c in n.get_children()])
+            path += n.dist
+        sums[n] = path
+    return sums[node]
+
+
 def get_distance_from_tree(tree):
     """Return a distance matrix from input tree
     """
@@ -402,15 +486,47 @@ def get_distance_from_tree(tree):
             "Cannot infer distance matrix from tree branch length. All branch are set to default")
     nl = len(node_order)  # number of leaf
     distance_mat = np.zeros((nl, nl), dtype=float)
-    for i in range(nl):
-        for j in range(i + 1, nl):
-            distance_mat[i, j] = distance_mat[
-                j, i] = tree.get_distance(node_order[i], node_order[j])
-    np.fill_diagonal(distance_mat, 0)
+    # One postorder traversal : each node keeps the distances of its leaves
+    # to it. Leaves are numbered in traversal order, so the leaves of a node
+    # are a slice of the matrix, and the distances between the leaves of two
+    # of its children are set when the node is reached.
+    # TreeNode.get_distance sums the path of one leaf, then the path of the
+    # other, in the order of the keys of a dict of the two names. Both orders
+    # are computed, and the dict is only built when they are not equal.
+    leaf_names = np.array(node_order, dtype=object)
+    blocks = {}
+    start = 0
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            first, dist = start, np.zeros(1)
+            start += 1
+        else:
+            children = node.get_children()
+            first, dist = blocks.pop(children[0])
+            for k, child in enumerate(children[1:], 1):
+                c_first, c_dist = blocks.pop(child)
+                last = c_first + len(c_dist)
+                # path of the leaf of child first, or last
+                child_first = np.concatenate(
+                    [__path_sums(prev, c_dist) for prev in children[:k]])
+                block = __path_sums(child, dist).T
+                rows, cols = np.nonzero(block != child_first)
+                pairs = izip(leaf_names[first + rows],
+                             leaf_names[c_first + cols])
+                # the path of the second key is summed first
+                use = np.array([dict([[a, None], [b, None]]).keys()[0] == a
+                                for a, b in pairs], dtype=bool)
+                block[rows[use], cols[use]] = child_first[rows[use], cols[use]]
+                distance_mat[first:c_first, c_first:last] = block
+                distance_mat[c_first:last, first:c_first] = block.T
+                dist = np.concatenate((dist, c_dist))
+        if node is not tree:
+            dist += node.dist
+        blocks[node] = (first, dist)
     return distance_mat, node_order
 
 
-def binaryRecScore(node, lcamap, dupcost=None, losscost=None):
+def binaryRecScore(node, lcamap, dupcost=None, losscost=None, costs=None):
     """Reconcile genetree topology to a specietree, using an adequate mapping obtained with lcaMapping.
     'reconcile' will infer evolutionary events like gene lost, gene speciation and gene duplication with distinction between AD and NAD
     """
@@ -419,12 +535,17 @@ def binaryRecScore(node, lcamap, dupcost=None, losscost=None):
     if(lcamap is None or node is None):
         raise Exception("lcaMapping or genetree not found")
     else:
+        # costs of the specietree nodes, from the index set by lcaMapping.
+        # Going up the edge above c loses the siblings of c, their cost is
+        # lossedge[c] (see SpeciesTreeIndex.loss_prefix)
+        table = lcamap[node].get_tree_root().lcaindex.costs(costs)
+        spdup, lossedge = table[0], table[2]
         # print node.name , node.species, " and children name ",
         # node.get_children_name()," and children species ",
         # node.get_children_species()
         if(not node.is_leaf() and (lcamap[node].name == lcamap[node.get_child_at(0)].name or lcamap[node].name == lcamap[node.get_child_at(1)].name)):
             if not dupcost:
-                dup += params.getdup(lcamap[node].name)
+                dup += spdup[lcamap[node].lcaid]
             else:
                 dup += dupcost
 
@@ -439,7 +560,7 @@ def binaryRecScore(node, lcamap, dupcost=None, losscost=None):
             if(dup == 0):
                 while(c is not None and (c.name not in supposed_children_species)):
                     if not losscost:
-                        lost += params.getloss(c.name)
+                        lost += lossedge[c.lcaid]
                     else:
                         lost += losscost
 
@@ -449,7 +570,7 @@ def binaryRecScore(node, lcamap, dupcost=None, losscost=None):
             if(dup > 0):
                 while(c is not None and c.name != node.species):
                     if not losscost:
-                        lost += params.getloss(c.name)
+                        lost += lossedge[c.lcaid]
                     else:
                         lost += losscost
                     child_lost += 1
@@ -528,73 +649,81 @@ def getReverseMap(lcamap, use_name=False):
     return reversedmap
 
 
-def getImageTreeNode(genetree, specietree, lcamap):
-    """ Get the specie image tree node of a genetree"""
+def getImageTreeArrays(genetree, specietree, lcamap, nodes=None):
+    """Compressed child-image subtree I(g) of each internal node g of the
+    genetree (or of each node in nodes) : the subtree of the specietree
+    spanned by the images of the children of g and their lca.
 
-    # get pre(s) for each  node in specietree
-    reversedmap = getReverseMap(lcamap)
+    Return a dict g -> (ids, parent), ids is the array of the lcaid of the
+    nodes of I(g) in preorder, and parent the array of the position in ids
+    of their parent (-1 for the root of I(g)). The depths are
+    specietree.lcaindex.depths[ids].
+    """
+    if not specietree.has_feature('lcaprocess', True):
+        lcaPreprocess(specietree)
+    index = specietree.lcaindex
+    if nodes is None:
+        nodes = [node for node in genetree.traverse("postorder")
+                 if not node.is_leaf()]
+    # images of the children sorted in preorder, and the lca of the
+    # consecutive ones (computed in one batch), give all the nodes of I(g)
+    images = [sorted(lcamap[child].lcaid for child in node.children)
+              for node in nodes]
+    pair_lca = iter(lcaQuery(specietree,
+                             [index.first[i] for ids in images for i in ids[:-1]],
+                             [index.first[i] for ids in images for i in ids[1:]]).tolist())
+    leafset = index.leafset
+    image_arrays = {}
+    for node, ids in zip(nodes, images):
+        ids = set(ids)
+        ids.update(next(pair_lca) for i in xrange(len(node.children) - 1))
+        ids = sorted(ids)
+        # the parent of a node is the last node on the path from the root
+        # (the stack) that is an ancestor of it
+        parent = []
+        stack = []
+        for pos, i in enumerate(ids):
+            while stack and leafset[i] & ~leafset[ids[stack[-1]]]:
+                stack.pop()
+            parent.append(stack[-1] if stack else -1)
+            stack.append(pos)
+        image_arrays[node] = (np.array(ids, dtype=int),
+                              np.array(parent, dtype=int))
+    return image_arrays
+
+
+def sortChildrenByImage(genetree, specietree, lcamap):
+    """Arange the children of each node of the genetree according to the
+    position of their images in post-order traversal of the specietree"""
+    postrank = dict((s, rank)
+                    for rank, s in enumerate(specietree.traverse("postorder")))
+    for node in genetree.traverse():
+        if node.children:
+            node.children.sort(key=lambda child: postrank[lcamap[child]])
+
+
+def getImageTreeNode(genetree, specietree, lcamap, nodes=None):
+    """ Get the specie image tree node of a genetree (of each internal node,
+    or of each node in nodes), see getImageTreeArrays"""
+
+    if not specietree.has_feature('lcaprocess', True):
+        lcaPreprocess(specietree)
     k = 0
-    # Traverse G in df order and set ih to 0 for internal node
     for node in genetree.iter_internal_node("levelorder", enable_root=True):
-        node.add_features(i_h=0)
         node.name = 'n%d' % k
+    sortChildrenByImage(genetree, specietree, lcamap)
 
-    # Arange the children of each node in G according to the position of their images
-    # in post-order traversal of S
-    for snode in specietree.traverse("postorder"):
-        for gnode in reversedmap[snode]:
-            p_gnode = gnode.up
-            if(p_gnode):
-                gnode_ind = [x for x in xrange(len(p_gnode.children)) if p_gnode.children[
-                    x] == gnode][0]
-                p_gnode.children[gnode_ind], p_gnode.children[
-                    p_gnode.i_h] = p_gnode.children[p_gnode.i_h], p_gnode.children[gnode_ind]
-                p_gnode.i_h += 1
-
-    # compute B(s) that contains all the gene tree nodes g / s in I(g) for s
-    # in S
-    B_array = ddict(list)
-    for node in genetree.traverse("postorder"):
-        childlist = node.get_children()
-        for child in childlist:
-            B_array[lcamap[child]].append(node)
-        for i in xrange(0, len(childlist) - 1):
-            B_array[getLca(specietree, [lcamap[childlist[i]],
-                                        lcamap[childlist[i + 1]]])].append(node)
-
-    # Store all the specie tree nodes of the compresses child-image subtree I(g)
-    # and construct all I(g)
-    # At this step, we are actually certain that the euler tour of S was
-    # already computed
-    image_tree_nodes = ddict(list)
-    for s in specietree.ind2node:
-        for h in B_array[s]:
-            image_tree_nodes[h].append(s)
-
-    # Here we are going to construct the tree
+    # Build each I(g), the children of a node are added in reverse preorder
     image_tree = {}
-    for node in genetree.traverse("postorder"):
-        nodecopied = {}
-        if not image_tree_nodes[node]:
-            continue
-        el1 = image_tree_nodes[node].pop()
-        a = el1._copy_node(features=['name', 'depth'])
-        nodecopied[el1] = a
-        while len(image_tree_nodes[node]) > 0:
-            el2 = image_tree_nodes[node].pop()
-            b = nodecopied.get(el2, None)
-            if not b:
-                b = el2._copy_node(features=['name', 'depth'])
-                nodecopied[el2] = b
-            if (a != b):
-                if a.depth < b.depth:
-                    if(b not in a.get_children()):
-                        a.add_child(b)
-                elif a.depth > b.depth:
-                    if(a not in b.get_children()):
-                        b.add_child(a)
-            a = b
-        image_tree[node] = a.get_tree_root()
+    id2node = specietree.id2node
+    image_arrays = getImageTreeArrays(genetree, specietree, lcamap, nodes)
+    for node, (ids, parent) in image_arrays.items():
+        copies = [TreeClass() for i in ids]
+        for copy, i in zip(copies, ids.tolist()):
+            copy.add_features(name=id2node[i].name, depth=id2node[i].depth)
+        for pos in xrange(len(ids) - 1, 0, -1):
+            copies[parent[pos]].add_child(copies[pos])
+        image_tree[node] = copies[0]
     return image_tree
 
 
@@ -608,11 +737,9 @@ def getSpecieGeneMap(genetree, specietree):
 
 
 def treeHash(tree, addinfos=''):
-    """Hashing the tree based on the sorted node name"""
-    newick_str = re.sub(
-        "(?<=\()([^()]+?)(?=\))", lambda m: ",".join(sorted(m.group(1).split(","))), tree.write(format=9))
-    # print "newick: ", tree.write(format=9), "parsing: ", newick_str
-    return hashlib.sha384(newick_str + addinfos).hexdigest()
+    """Hashing the tree based on its structural hash (the topology and the
+    leaf names, whatever the order of the children)"""
+    return hashlib.sha384(tree.structural_hash() + addinfos).hexdigest()
 
 
 def newickPreprocessing(newick, gene_sep=None):
@@ -644,8 +771,12 @@ def newickPreprocessing(newick, gene_sep=None):
         raise NewickError("'newick' argument must be either a filename or a newick string.")
 
 
-def polySolverPreprocessing(genetree, specietree, distance_mat, capitalize=False, gene_sep=None, specie_pos="postfix", nFlagVal=1e305, nFlag=False, smap=None, errorproof=False):
+def polySolverPreprocessing(genetree, specietree, distance_mat, capitalize=False, gene_sep=None, specie_pos="postfix", nFlagVal=1e305, nFlag=False, smap=None, errorproof=False, condensed=False, cache=False):
     """Preprocess genetree for polytomysolver
+    If condensed is True, the distance matrix is returned as a float32
+    CondensedMatrix
+    If cache is True, the distance file is read from a binary cache
+    (see ClusterUtils.distMatProcessor)
     """
 
     # genetree input
@@ -696,7 +827,7 @@ def polySolverPreprocessing(genetree, specietree, distance_mat, capitalize=False
     if(distance_mat):
         if isinstance(distance_mat, basestring):
             gene_matrix, node_order = clu.distMatProcessor(
-                distance_mat, nFlagVal, nFlag)
+                distance_mat, nFlagVal, nFlag, cache=cache)
         else:
             # distance mat is provided as a boolean
             # in that case, just try to get it from the genetree
@@ -725,6 +856,8 @@ def polySolverPreprocessing(genetree, specietree, distance_mat, capitalize=False
                     elif exib1:
                         print("Genes in matrix and not in tree : %s \nAttempt to correct distance matrix" % (
                             ", ".join(exib1)))
+                        # the binary cache is read-only
+                        gene_matrix = np.array(gene_matrix)
                         for l in exib1:
                             try:
                                 lpos = node_order.index(l)
@@ -734,6 +867,8 @@ def polySolverPreprocessing(genetree, specietree, distance_mat, capitalize=False
                             except:
                                 raise IndexError(
                                     "Could not remove gene %s from distance matrix" % l)
+        if condensed:
+            gene_matrix = clu.CondensedMatrix(gene_matrix)
 
     else:
         # This is for debug, will never happen
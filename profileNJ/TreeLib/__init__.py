@@ -1,4 +1,5 @@
 from TreeClass import TreeClass
+from SpeciesTreeIndex import SpeciesTreeIndex
 from memorize import memorize
 import params
-__all__ = ["TreeUtils", "ClusterUtils", "TreeClass", "memorize", "params"]
+__all__ = ["TreeUtils", "ClusterUtils", "TreeClass", "SpeciesTreeIndex", "memorize", "params"]
@@ -1,37 +1,169 @@
+import hashlib
+import os
+import sys
 from collections import Hashable as hashable
+from collections import OrderedDict
 from functools import partial
 
+import numpy as np
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
 
 class memorize(object):
     """Cache function output when it's called and return it
     later when the same function is called with the same input,
     in this case, memorize use a hash to determine value to reevalute
+
+    The cache is bounded : the least recently used outputs are evicted when
+    there are more than `maxsize` outputs, or when their approximate size is
+    more than `maxbytes` (no bound when it's None). The outputs are only
+    sized when maxbytes is set, the outputs cached before don't count. The
+    bounds can be changed for all the caches on the class, or for one of
+    them on the instance.
+
+    When `cachedir` is set, the outputs are also pickled in cachedir (one
+    directory by function), and read back by the next runs, or by other
+    processes, for the same hash. The hash should then identify the input
+    across runs. Each file contains the hash and a digest of the pickled
+    output, that are checked before loading it.
     """
 
+    maxsize = 10000
+    maxbytes = None
+    cachedir = None
+    # all the memorized functions, see all_stats
+    _instances = []
+
     def __init__(self, function):
         self.function = function
-        self.cache = {}
+        self.cache = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.diskhits = 0
+        memorize._instances.append(self)
 
     def __call__(self, hash, *args, **kwargs):
         """Call to memorize, (as decorator)"""
 
-        if hash in self.cache:
-            return self.cache[hash]
-
-        elif not isinstance(hash, hashable) or hash is None:
+        if not isinstance(hash, hashable) or hash is None:
             # hash is None or uncachable
             return self.function(*args, **kwargs)
 
+        elif hash in self.cache:
+            self.hits += 1
+            output = self.cache.pop(hash)
+            self.cache[hash] = output
+            return output
+
         else:
-            output = self.function(*args, **kwargs)
+            cachefile = self.cachefile(hash) if self.cachedir else None
+            output = self.load(cachefile, hash) if cachefile else None
+            if output is not None:
+                self.diskhits += 1
+            else:
+                self.misses += 1
+                output = self.function(*args, **kwargs)
+                if cachefile:
+                    self.save(cachefile, hash, output)
             self.cache[hash] = output
+            if self.maxbytes:
+                self.sizes[hash] = approx_size(output)
+                self.nbytes += self.sizes[hash]
+            self.evict()
             return output
 
+    def evict(self):
+        """Remove the least recently used outputs until the cache is in its
+        bounds (the last output is always kept)"""
+        while len(self.cache) > 1 and \
+                ((self.maxsize and len(self.cache) > self.maxsize) or
+                 (self.maxbytes and self.nbytes > self.maxbytes)):
+            hash, output = self.cache.popitem(last=False)
+            self.nbytes -= self.sizes.pop(hash, 0)
+            self.evictions += 1
+
+    def cachefile(self, hash):
+        """Path of the file of hash in cachedir"""
+        return os.path.join(self.cachedir, self.function.__name__,
+                            hashlib.sha1(repr(hash)).hexdigest() + '.pkl')
+
+    @staticmethod
+    def load(cachefile, hash):
+        """Load the output saved for hash, return None if it can't be read
+        or if the file doesn't match hash"""
+        try:
+            with open(cachefile, 'rb') as infile:
+                saved, digest, data = pickle.load(infile)
+            if saved != repr(hash) or hashlib.sha1(data).hexdigest() != digest:
+                return None
+            return pickle.loads(data)
+        except (IOError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return None
+
+    @staticmethod
+    def save(cachefile, hash, output):
+        """Pickle output with hash, the file is replaced only when complete"""
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cachefile)):
+                os.makedirs(os.path.dirname(cachefile))
+            data = pickle.dumps(output, pickle.HIGHEST_PROTOCOL)
+            with open(tmpfile, 'wb') as outfile:
+                pickle.dump((repr(hash), hashlib.sha1(data).hexdigest(), data),
+                            outfile, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, cachefile)
+        except (IOError, OSError, RuntimeError, pickle.PicklingError):
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        self.cache.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.diskhits = 0
+
+    def stats(self):
+        """Return the hit (in memory and in cachedir), miss and eviction
+        counters, and the number and approximate size (in bytes, 0 when
+        maxbytes is not set) of the cached outputs"""
+        return {'hits': self.hits, 'diskhits': self.diskhits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.cache),
+                'bytes': self.nbytes}
+
+    @classmethod
+    def all_stats(cls):
+        """Return the stats of each memorized function, by function name"""
+        return dict((instance.function.__name__, instance.stats())
+                    for instance in cls._instances)
+
     def __repr__(self):
         """Return cached data"""
-        for hash, data in self.cache:
-            print hash, '=============>\n', data
+        return "\n".join('%s =============>\n%s' % (hash, data)
+                         for hash, data in self.cache.items())
 
     def __get__(self, obj, objtype):
         """Instance methods support"""
         return partial(self.__call__, obj)
+
+
+def approx_size(obj):
+    """Approximate size in bytes of obj : the size of the containers and
+    of their content, of the numpy arrays data and of the nodes of the trees"""
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + obj.nbytes
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(approx_size(x) for x in obj)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v)
+                                        for k, v in obj.items())
+    elif hasattr(obj, 'traverse'):
+        return sum(sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+                   for node in obj.traverse())
+    return sys.getsizeof(obj)
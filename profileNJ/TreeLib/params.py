@@ -7,18 +7,121 @@ __author__ = "Emmanuel Noutahi"
 import hashlib
 import numpy as np
 
-cdup, closs = 1, 1
-dupcost, losscost = {}, {}
-internal_type = 0
+
+class CostModel(object):
+    """Duplication and loss costs : a cost for each specie (keyed by the
+    hash of its leaf names, see get_hash) and a default cost for the others.
+
+    A CostModel can be passed to the solvers and to the scoring functions,
+    so runs with different costs don't share any state. The functions of
+    this module use the `default` model, set with params.set. The solvers
+    with constant costs (PolySolver, ZhengPolySolver) use cdup and closs.
+    """
+
+    def __init__(self, dup=None, loss=None, constdlcost=(1, 1), internal_mode='default'):
+        self.set(dup or {}, loss or {}, constdlcost, internal_mode)
+
+    def set(self, dup, loss, constdlcost=(1, 1), internal_mode='default'):
+        self.dupcost, self.losscost = dup, loss
+        self.cdup, self.closs = constdlcost
+        self.internal_type = 1 if internal_mode == 'mean' else 0
+        costs = (sorted(self.dupcost.items()), sorted(self.losscost.items()),
+                 self.cdup, self.closs, self.internal_type)
+        self.key = hashlib.sha1(repr(costs)).hexdigest()
+
+    def getdup(self, specie=None):
+        slist = specie
+        if specie and not isinstance(specie, basestring):
+            slist = specie.get_leaf_names()
+        if len(slist) > 1:
+            return self.get_internal(specie, self.getdup, ctype="dup")
+        else:
+            return self.dupcost.get(get_hash(slist), self.cdup)
+
+    def getloss(self, specie=None):
+        slist = specie
+        if specie and not isinstance(specie, basestring):
+            slist = specie.get_leaf_names()
+        if len(slist) > 1:
+            return self.get_internal(specie, self.getloss)
+        else:
+            return self.losscost.get(get_hash(slist), self.closs)
+
+    def get_internal(self, specie, costfun, ctype="loss"):
+        if not isinstance(specie, basestring) and (specie.is_internal() or specie.is_root()) and self.internal_type == 1:
+            defcost = np.mean([costfun(s) for s in specie.get_leaves()])
+        else:
+            defcost = self.closs if ctype == 'loss' else self.cdup
+        return defcost
+
+    def float_costs(self, ctype="loss"):
+        """True when the loss (or dup) costs are floats, or means of the leaf
+        costs : their sums are then floats"""
+        if ctype == 'loss':
+            values = self.losscost.values() + [self.closs]
+        else:
+            values = self.dupcost.values() + [self.cdup]
+        return self.internal_type == 1 or any(isinstance(v, float) for v in values)
+
+    def compile_costs(self, tree):
+        """Return the nodes of tree in preorder, and the arrays of their dup and
+        loss costs (the values of getdup and getloss), computed in one traversal"""
+        nodes = list(tree.traverse("preorder"))
+        ids = dict((node, i) for i, node in enumerate(nodes))
+        parent = [ids[node.up] if node is not tree else -1 for node in nodes]
+        names = [node.name if node.is_leaf() else None for node in nodes]
+        dup, loss = self.compile_index(names, parent)
+        return nodes, dup, loss
+
+    def compile_index(self, names, parent):
+        """Same as compile_costs, from the nodes given by position in preorder :
+        the leaf names (None for internal nodes) and the parent positions"""
+        # sum of the costs of the leaves under each node, and number of leaves
+        leafdup = np.zeros(len(names))
+        leafloss = np.zeros(len(names))
+        nleaves = np.zeros(len(names), dtype=int)
+        for i in xrange(len(names) - 1, -1, -1):
+            if names[i] is not None:
+                hashed = get_hash([names[i]])
+                leafdup[i] = self.dupcost.get(hashed, self.cdup)
+                leafloss[i] = self.losscost.get(hashed, self.closs)
+                nleaves[i] = 1
+            p = parent[i]
+            if p >= 0:
+                leafdup[p] += leafdup[i]
+                leafloss[p] += leafloss[i]
+                nleaves[p] += nleaves[i]
+
+        if self.internal_type == 1:
+            dup, loss = leafdup / nleaves, leafloss / nleaves
+        else:
+            dup, loss = np.full(len(names), self.cdup, dtype=float), \
+                np.full(len(names), self.closs, dtype=float)
+        single = nleaves == 1
+        dup[single], loss[single] = leafdup[single], leafloss[single]
+        return dup, loss
+
+
+default = CostModel()
+# kept for the code reading the costs of the default model
+cdup, closs = default.cdup, default.closs
+dupcost, losscost = default.dupcost, default.losscost
+internal_type = default.internal_type
 
 
 def set(dup, loss, constdlcost=(1, 1), internal_mode='default'):
     global dupcost, losscost
     global cdup, closs
     global internal_type
+    default.set(dup, loss, constdlcost, internal_mode)
     dupcost, losscost = dup, loss
     cdup, closs = constdlcost
-    internal_type = 1 if internal_mode == 'mean' else 0
+    internal_type = default.internal_type
+
+
+def get_model(costs=None):
+    """Return costs, or the default model when it's None"""
+    return default if costs is None else costs
 
 
 def get_hash(splist):
@@ -28,31 +131,16 @@ def get_hash(splist):
 
 
 def getdup(specie=None):
-    global dupcost, cdup
-    slist = specie
-    if specie and not isinstance(specie, basestring):
-        slist = specie.get_leaf_names()
-    if len(slist) > 1:
-        return get_internal(specie, getdup, ctype="dup")
-    else:
-        return dupcost.get(get_hash(slist), cdup)
+    return default.getdup(specie)
 
 
 def getloss(specie=None):
-    global losscost, closs
-    slist = specie
-    if specie and not isinstance(specie, basestring):
-        slist = specie.get_leaf_names()
-    if len(slist) > 1:
-        return get_internal(specie, getloss)
-    else:
-        return losscost.get(get_hash(slist), closs)
+    return default.getloss(specie)
 
 
 def get_internal(specie, costfun, ctype="loss"):
-    global internal_type, closs, cdup
-    if not isinstance(specie, basestring) and (specie.is_internal() or specie.is_root()) and internal_type == 1:
-        defcost = np.mean([costfun(s) for s in specie.get_leaves()])
-    else:
-        defcost = closs if ctype == 'loss' else cdup
-    return defcost
+    return default.get_internal(specie, costfun, ctype)
+
+
+def compile_costs(tree):
+    return default.compile_costs(tree)
@@ -8,8 +8,13 @@ from ..TreeLib import TreeClass
 from ..tests import dirname
 import numpy as np
 import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from xml.etree import ElementTree
 
 distmatfilename1 = os.path.join(dirname, "distmat/distmat1.dist")
+distmatfilename2 = os.path.join(dirname, "distmat/distmat2.dist")
 
 
 class TestCluster(unittest.TestCase):
@@ -35,6 +40,93 @@ class TestCluster(unittest.TestCase):
         assert np.array_equal(self.distmat1, loadmat1[0])
         assert self.node_names == loadmat1[1]
 
+    def test_parse_phylip_matrix(self):
+        lines = ["\t3", "a\t0 -1 2", "", "b -1\t0 3", "c 2 3 5"]
+        matrix, names = C.parsePhylipMatrix(lines, 100, nFlag=True)
+        assert names == ['a', 'b', 'c']
+        assert np.array_equal(
+            matrix, [[0, 100, 2], [100, 0, 3], [2, 3, 0]])
+        matrix, names = C.parsePhylipMatrix(lines[:3], 100)
+        assert names == ['a'] and np.array_equal(matrix, [[0, -1, 2]])
+
+    def test_parse_fastphylo_xml(self):
+        xml = ['<?xml version="1.0"?>', '<root><run dim="3">',
+               '<identities><identity name="a"/><identity name="b"/>',
+               '<identity name="c"/></identities><dms><dm>',
+               '<row><entry>0</entry></row>',
+               '<row><entry>-1</entry><entry>0</entry></row>',
+               '<row><entry>2</entry><entry>3</entry><entry>0</entry></row>',
+               '</dm><dm><row><entry>7</entry></row></dm></dms></run></root>']
+        etree = C.etree
+        try:
+            # with lxml and without it
+            for C.etree in [etree, ElementTree]:
+                matrix, names = C.distMatProcessor(
+                    StringIO("\n".join(xml)), 100, nFlag=True)
+                assert names == ['a', 'b', 'c']
+                assert np.array_equal(
+                    matrix, [[0, 100, 2], [100, 0, 3], [2, 3, 0]])
+        finally:
+            C.etree = etree
+
+    def test_matrix_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            distfile = os.path.join(tmpdir, "distmat1.dist")
+            shutil.copy(distmatfilename1, distfile)
+            cachefile = distfile + C.CACHE_EXT
+            digest = C.fileDigest
+            hashed = []
+
+            def counted_digest(filename):
+                hashed.append(filename)
+                return digest(filename)
+            C.fileDigest = counted_digest
+            try:
+                for i in range(2):
+                    matrix, names = C.distMatProcessor(distfile, cache=True)
+                    assert isinstance(matrix, np.memmap)
+                    assert np.array_equal(matrix, self.distmat1)
+                    assert names == self.node_names
+                # hashed once to save the cache, not when it's read
+                assert len(hashed) == 1
+                # the node order is saved in the same file, after the matrix
+                assert sorted(os.listdir(tmpdir)) == ['distmat1.dist',
+                                                      'distmat1.dist.npy']
+                assert np.array_equal(np.load(cachefile), self.distmat1)
+                # the file is hashed when only its time changes, the cache is
+                # still valid
+                inode = os.stat(cachefile).st_ino
+                os.utime(distfile, (1, 1))
+                assert C.distMatProcessor(distfile, cache=True)[1] == names
+                assert len(hashed) == 2 and os.stat(cachefile).st_ino == inode
+            finally:
+                C.fileDigest = digest
+            # the cache is rebuilt when the file changes
+            with open(distfile, 'w') as out:
+                out.write("\t3\nx 0 1 2\ny 1 0 3\nz 2 3 0\n")
+            matrix, names = C.distMatProcessor(distfile, cache=True)
+            assert names == ['x', 'y', 'z']
+            # same size, other distances
+            with open(distfile, 'w') as out:
+                out.write("\t3\nx 0 1 4\ny 1 0 3\nz 4 3 0\n")
+            os.utime(distfile, (2, 2))
+            matrix, names = C.distMatProcessor(distfile, cache=True)
+            assert np.array_equal(matrix, [[0, 1, 4], [1, 0, 3], [4, 3, 0]])
+            with open(distfile, 'w') as out:
+                out.write("\t3\nx 0 1 2\ny 1 0 3\nz 2 3 0\n")
+            matrix, names = C.distMatProcessor(distfile, cache=True)
+            assert names == ['x', 'y', 'z']
+            matrix, names = C.distMatProcessor(distfile + C.CACHE_EXT)
+            assert names == ['x', 'y', 'z']
+            # changes on the copy are not written in the cache
+            copy = C.copyMatrix(matrix)
+            C.condense_matrix(copy, (1, 0), 'nj')
+            assert np.array_equal(copy.to_array(), [[0, 2], [2, 0]])
+            assert np.array_equal(matrix, [[0, 1, 2], [1, 0, 3], [2, 3, 0]])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_q_matrix(self):
         tmpqmat1 = C.calculate_Q_matrix(self.distmat1)
         np.fill_diagonal(tmpqmat1, 0)
@@ -44,6 +136,36 @@ class TestCluster(unittest.TestCase):
         s = C.find_smallest_index(self.qmat1)
         assert sorted(s) == self.first_smallest_ind
 
+    def test_cluster_matrix(self):
+        matrice = np.copy(self.upgmamat)
+        cluster_mat = C.ClusterMatrix(self.upgmamat, copy=True)
+        buffer = cluster_mat.buffer
+        for index, method in [((3, 1), 'nj'), ((2, 0), 'upgma'), ((1, 0), 'nj')]:
+            matrice = C.condense_matrix(matrice, index, method)
+            C.condense_matrix(cluster_mat, index, method)
+            assert cluster_mat.shape == matrice.shape
+            assert np.array_equal(cluster_mat.to_array(), matrice)
+            assert np.array_equal(cluster_mat[1], matrice[1])
+            assert cluster_mat[1, 0] == matrice[1, 0]
+            # the distances are never copied in a new array
+            assert np.may_share_memory(cluster_mat.buffer, buffer)
+        # the smallest distance is searched in the same scratch matrice
+        cluster_mat.find_smallest_index()
+        scratch = cluster_mat._scratch
+        assert cluster_mat.find_smallest_index() == (1, 0)
+        assert cluster_mat._scratch is scratch
+
+    def test_condensed_matrix(self):
+        loadmat1 = C.distMatProcessor(distmatfilename1, condensed=True)[0]
+        assert isinstance(loadmat1, C.CondensedMatrix)
+        assert loadmat1.buffer.dtype == np.float32
+        assert loadmat1.buffer.shape == (10,)
+        assert np.array_equal(loadmat1.to_array(), self.distmat1)
+        condensed = C.CondensedMatrix(self.distmat1, dtype=float)
+        C.condense_matrix(condensed, (1, 0), 'nj')
+        assert np.array_equal(condensed.to_array(), self.condmat1)
+        assert np.array_equal(condensed.submatrix([0, 3]), [[0, 6], [6, 0]])
+
     def test_paired_node_distance(self):
         i, j = sorted(self.first_smallest_ind)
         assert C.paired_node_distance(self.distmat1, (i, j)) == (2, 3)
@@ -61,6 +183,87 @@ class TestCluster(unittest.TestCase):
         rf = t1_nj.robinson_foulds(t2_nj, unrooted_trees=True)
         assert rf[0] == 0
 
+    def test_nj_row_sums(self):
+        for seed in range(6):
+            rand_mat = np.random.RandomState(seed).rand(60, 60)
+            rand_mat += rand_mat.T
+            np.fill_diagonal(rand_mat, 0)
+            trees = []
+            for use_row_sums in [True, False]:
+                matrice = np.copy(rand_mat)
+                node_order = [TreeClass(name=str(x)) for x in range(60)]
+                if use_row_sums:
+                    tree = C.NJ_cluster(matrice, node_order)[0]
+                else:
+                    # the Q matrix is computed again for each join
+                    for i in range(59):
+                        smallest_index = tuple(C.find_smallest_index(
+                            C.calculate_Q_matrix(matrice)))
+                        C.condense_node_order(
+                            matrice, smallest_index, node_order, method='nj')
+                        matrice = C.condense_matrix(
+                            matrice, smallest_index, method='nj')
+                    tree = node_order[0]
+                trees.append(tree.write(format=9))
+            assert trees[0] == trees[1]
+
+    def test_rapidnj(self):
+        for distmatfile in [distmatfilename1, distmatfilename2]:
+            trees = []
+            for method in ['nj', 'rapidnj']:
+                matrix, names = C.distMatProcessor(distmatfile)
+                node_order = [TreeClass(name=x) for x in names]
+                tree, final_array, smallest_index = C.treeCluster(
+                    matrix, node_order, depth=None, method=method)
+                trees.append(tree.write(format=5))
+            assert trees[0] == trees[1]
+
+    def test_rapidnj_random(self):
+        for seed in range(40):
+            rand = np.random.RandomState(seed)
+            n = rand.randint(3, 50)
+            if seed % 2:
+                rand_mat = rand.rand(n, n)
+            else:
+                # small integers, with a lot of ties
+                rand_mat = rand.randint(1, 4, size=(n, n)).astype(float)
+            rand_mat += rand_mat.T
+            np.fill_diagonal(rand_mat, 0)
+            for depth in [None, n // 2]:
+                results = []
+                for cluster in [C.NJ_cluster, C.RAPIDNJ_cluster]:
+                    node_order = [TreeClass(name=str(x)) for x in range(n)]
+                    tree, matrix, smallest_index = cluster(
+                        np.copy(rand_mat), node_order, depth)
+                    results.append(([x.write(format=5) for x in node_order],
+                                    matrix, tuple(smallest_index)))
+                assert results[0][0] == results[1][0]
+                assert np.array_equal(results[0][1], results[1][1])
+                assert results[0][2] == results[1][2]
+
+    def test_upgma_nn_chain(self):
+        rand_mat = np.random.RandomState(42).rand(30, 30)
+        rand_mat += rand_mat.T
+        np.fill_diagonal(rand_mat, 0)
+        assert C.nn_chain_merges(rand_mat) is not None
+        trees = []
+        for use_nn_chain in [True, False]:
+            matrice = np.copy(rand_mat)
+            node_order = [TreeClass(name=str(x)) for x in range(30)]
+            if use_nn_chain:
+                tree = C.UPGMA_cluster(matrice, node_order)[0]
+            else:
+                # join one pair at a time, with find_smallest_index
+                for i in range(29):
+                    smallest_index = tuple(C.find_smallest_index(matrice))
+                    C.condense_node_order(
+                        matrice, smallest_index, node_order, method='upgma')
+                    matrice = C.condense_matrix(
+                        matrice, smallest_index, method='upgma')
+                tree = node_order[0]
+            trees.append(tree.write(features=['length'], format=9))
+        assert trees[0] == trees[1]
+
     def test_upgma(self):
         node_order = [TreeClass("a:1;"), TreeClass("b:1;"), TreeClass(
             "c:1;"), TreeClass("d:1;"), TreeClass("e:1;")]
@@ -7,9 +7,13 @@ from ..TreeLib import ClusterUtils as C
 from ..TreeLib import TreeClass
 from ..TreeLib.TreeUtils import *
 from ..TreeLib import params
+from ..TreeLib import SpeciesTreeIndex
 from ..tests import dirname
 import numpy as np
 import os
+import pickle
+import shutil
+import tempfile
 
 
 genefile1 = os.path.join(dirname, "genetree/gtree1.nw")
@@ -65,6 +69,123 @@ class TestReconciliation(unittest.TestCase):
         d2, l2 = computeDL(self.gtree2)
         assert d1 == 0 and l1 == 2 and d2 == 6 and l2 == 4
 
+    def test_lca(self):
+        tree = TreeClass("(((a,b)e,c)f,(d,g)i)h;", format=1)
+        index = lcaPreprocess(tree)
+        assert "".join(tree.id2node[i].name for i in index.euler) == \
+            "hfeaebefcfhidigih"
+        assert [index.first[(tree & n).lcaid] for n in 'abcdg'] == [3, 5, 8, 12, 14]
+        expected = {'ab': 'e', 'ac': 'f', 'bd': 'h', 'dg': 'i', 'ef': 'f',
+                    'ei': 'h', 'ci': 'h', 'aa': 'a', 'gh': 'h'}
+        for pair, lca in expected.items():
+            nodes = [tree & n for n in pair]
+            assert getLca(tree, nodes).name == lca
+            assert getLca(tree, nodes[::-1]).name == lca
+        assert getLca(tree, ['g']) == tree & 'g'
+        assert getLca(tree, [tree & n for n in 'abc']).name == 'f'
+        assert [(tree & n).depth for n in 'hfeai'] == [0, 1, 2, 3, 1]
+        # batched queries on the positions in the euler tour
+        pos = [index.first[(tree & pair[0]).lcaid] for pair in expected]
+        pos2 = [index.first[(tree & pair[1]).lcaid] for pair in expected]
+        lcas = lcaQuery(tree, pos, pos2)
+        assert [tree.id2node[i].name for i in lcas] == expected.values()
+
+    def test_species_tree_index(self):
+        newick = "(((a,b)e,c)f,(d,g)i)h;"
+        tree = TreeClass(newick, format=1)
+        index = SpeciesTreeIndex.get(tree)
+        assert tree.lcaindex is index and tree.id2node[0] is tree
+        assert index.leafset[(tree & 'f').lcaid] == 0b111
+        assert index.leafset[tree.lcaid] == 0b11111
+        assert [(tree & n).depth for n in 'hfeai'] == [0, 1, 2, 3, 1]
+        # the same index is bound to a new parse of the tree
+        tree2 = TreeClass(newick, format=1)
+        assert SpeciesTreeIndex.get(tree2) is index
+        assert getLca(tree2, [tree2 & 'a', tree2 & 'c']) is tree2 & 'f'
+        # and to a pickled copy saved in cachedir
+        tmpdir = tempfile.mkdtemp()
+        cache = SpeciesTreeIndex._cache.copy()
+        try:
+            SpeciesTreeIndex.cachedir = tmpdir
+            SpeciesTreeIndex._cache.clear()
+            SpeciesTreeIndex.get(tree)
+            assert os.listdir(tmpdir) == [index.key + '.pkl']
+            SpeciesTreeIndex._cache.clear()
+            loaded = SpeciesTreeIndex.get(tree2)
+            assert loaded is not index and loaded.key == index.key
+            assert np.array_equal(loaded.rmq, index.rmq)
+            assert getLca(tree2, [tree2 & 'd', tree2 & 'c']) is tree2
+            # a corrupted file is a cache miss, and is saved again
+            cachefile = os.path.join(tmpdir, index.key + '.pkl')
+            for data in ['', 'not a pickle', 'I1x\n.', pickle.dumps([1, 2])]:
+                with open(cachefile, 'wb') as outfile:
+                    outfile.write(data)
+                SpeciesTreeIndex._cache.clear()
+                assert SpeciesTreeIndex.get(tree2).key == index.key
+                assert SpeciesTreeIndex.load(cachefile).key == index.key
+        finally:
+            SpeciesTreeIndex.cachedir = None
+            SpeciesTreeIndex._cache.clear()
+            SpeciesTreeIndex._cache.update(cache)
+            shutil.rmtree(tmpdir)
+
+    def test_lca_mapping(self):
+        self.gtree2.set_species(pos="prefix")
+        lcamap = lcaMapping(self.gtree2, self.stree)
+        for node in self.gtree2.traverse():
+            species = node.get_leaf_species()
+            if len(species) == 1:
+                expected = self.stree & species.pop()
+            else:
+                expected = self.stree.get_common_ancestor(species)
+            assert lcamap[node] == expected
+
+    def test_lca_mapping_array(self):
+        self.gtree2.set_species(pos="prefix")
+        lcamap = lcaMapping(self.gtree2, self.stree)
+        species = [n.species for n in self.gtree2.traverse("postorder")]
+        d, l = computeDL(self.gtree2)
+
+        gtree = self.gtree2.copy()
+        gtree.del_feature('lcaMap')
+        for node in gtree.traverse():
+            if not node.is_leaf():
+                node.del_feature('species')
+        lcaarray = lcaMapping(gtree, self.stree, asarray=True)
+        assert not gtree.has_feature('lcaMap')
+        assert [self.stree.id2node[s] for s in lcaarray] == \
+            [lcamap[n] for n in self.gtree2.traverse("postorder")]
+        assert computeDL(gtree, lcaarray, self.stree) == (d, l)
+        assert computeDLScore(gtree, lcaarray, specietree=self.stree) == \
+            computeDLScore(self.gtree2)
+        setSpeciesFeatures(gtree, self.stree, lcaarray)
+        assert [n.species for n in gtree.traverse("postorder")] == species
+
+    def test_distance_from_tree(self):
+        tree = TreeClass(
+            "((a:0.5,b:0.25,c:1):0.125,(d:2,(e:0.75,f:0.5):1.5):0.25);")
+        matrix, names = get_distance_from_tree(tree)
+        assert names == list('abcdef')
+        assert not matrix.diagonal().any()
+        for i in xrange(len(names)):
+            for j in xrange(i + 1, len(names)):
+                dist = tree.get_distance(names[i], names[j])
+                assert matrix[i, j] == matrix[j, i] == dist
+        # lengths that are not exact in binary, the sums are rounded as
+        # get_distance does
+        rand = np.random.RandomState(5)
+        tree = TreeClass()
+        tree.populate(40)
+        for node in tree.traverse():
+            node.dist = rand.rand() * 3
+        matrix, names = get_distance_from_tree(tree)
+        for i in xrange(len(names)):
+            for j in xrange(i + 1, len(names)):
+                dist = tree.get_distance(names[i], names[j])
+                assert matrix[i, j] == matrix[j, i] == dist
+        with self.assertRaises(ValueError):
+            get_distance_from_tree(TreeClass("((a,b),c);"))
+
     def test_computeCost(self):
         import hashlib
         dupcost = {}
@@ -83,3 +204,125 @@ class TestReconciliation(unittest.TestCase):
         d, l = computeDLScore(self.gtree1)
         assert d == 0
         self.assertAlmostEqual(l, 2.75)
+
+    def test_dl_score_per_species(self):
+        stree = TreeClass("((a,b)e,(c,d)f)r;", format=1)
+        gtree = TreeClass("((a_1,c_1),(a_2,b_1));")
+        gtree.set_species(pos="prefix")
+        losscost = {params.get_hash(['b']): 2, params.get_hash(['d']): 0.5}
+        try:
+            params.set({}, losscost)
+            lcaMapping(gtree, stree)
+            # one dup at r, losses of f (under the dup), b and d
+            assert computeDLScore(gtree) == (1, 3.5)
+            dup, loss = computeDLScore(gtree, dupcost=3, losscost=2)
+            assert (dup, loss) == (3, 6)
+            # python numbers, with the type of the costs
+            assert type(dup) is int and type(loss) is int
+            dup, loss = computeDLScore(gtree)
+            assert type(dup) is int and type(loss) is float
+            dup, loss = computeDLScore(gtree, dupcost=57.0, losscost=2)
+            assert type(dup) is float and type(loss) is int
+            dup, loss = computeDLScore(
+                gtree, costs=params.CostModel(constdlcost=(1.0, 1.0)))
+            assert (dup, loss) == (1, 3) and type(dup) is type(loss) is float
+            assert str(dup) == '1.0'
+            lcaarray = lcaMapping(gtree, stree, asarray=True)
+            assert computeDLScore(gtree, lcaarray, specietree=stree) == (1, 3.5)
+        finally:
+            params.set({}, {})
+
+    def test_compile_costs(self):
+        dupcost = {params.get_hash(['dmel']): 2, params.get_hash(['dsim']): 3}
+        losscost = {params.get_hash(['dper']): 1.5}
+        try:
+            for mode in ('default', 'mean'):
+                params.set(dupcost, losscost, internal_mode=mode)
+                nodes, dup, loss = params.compile_costs(self.stree)
+                assert nodes[0] is self.stree
+                for node, d, l in zip(nodes, dup, loss):
+                    self.assertAlmostEqual(d, params.getdup(node))
+                    self.assertAlmostEqual(l, params.getloss(node))
+        finally:
+            params.set({}, {})
+
+    def test_cost_model(self):
+        stree = TreeClass("((a,b)e,(c,d)f)r;", format=1)
+        gtree = TreeClass("((a_1,c_1),(a_2,b_1));")
+        gtree.set_species(pos="prefix")
+        lcaMapping(gtree, stree)
+        costs = params.CostModel({params.get_hash(['a']): 4},
+                                 {params.get_hash(['b']): 2}, (1, 0.5))
+        # the default model is not changed by the other models
+        assert computeDLScore(gtree, costs=costs) == (1, 3)
+        assert computeDLScore(gtree) == (1, 3)
+        nodes, dup, loss = costs.compile_costs(stree)
+        assert dict(zip([n.name for n in nodes], dup))['a'] == 4
+        assert params.compile_costs(stree)[1].tolist() == [1] * 7
+
+    def test_reconcile_lost(self):
+        stree = TreeClass("((a,b,c)e,(d,f)g)r;", format=1)
+        gtree = TreeClass("((a_1,c_1),(a_2,(b_1,d_1)));")
+        gtree.set_species(pos="prefix")
+        lcamap = lcaMapping(gtree, stree)
+        reconcile(gtree, lcamap, lost=True)
+        assert gtree.write(format=9) == "((((lost_2_a|c,b_1),(lost_f,d_1))," + \
+            "(lost_5_d|f,(lost_4_b|c,a_2))),(lost_6_d|f,(a_1,c_1,lost_b)));"
+        lost = dict((n.name, n.species)
+                    for n in gtree.traverse() if n.type == TreeClass.LOST)
+        assert lost['lost_2_a|c'] == 'a,c' and lost['lost_b'] == 'b'
+        assert gtree.type == TreeClass.AD and gtree.dup
+        assert lcamap[gtree.get_child_at(1)] is stree
+
+        self.gtree2.set_species(pos="prefix")
+        lcaMapping(self.gtree2, self.stree)
+        dl = computeDL(self.gtree2)
+        reconcile(self.gtree2, self.gtree2.lcaMap, lost=True)
+        assert computeDL(self.gtree2) == dl
+
+    def test_species_bits(self):
+        stree = TreeClass("((a,b,c)e,(d,f)g)r;", format=1)
+        gtree = TreeClass("((a_1,c_1),(a_2,(b_1,d_1)));")
+        gtree.set_species(pos="prefix")
+        reconcile(gtree, lcaMapping(gtree, stree), lost=True)
+        index = stree.lcaindex
+        for node in gtree.traverse():
+            species = set(",".join(l.species for l in node).split(","))
+            assert index.leaf_names(node.get_species_bits()) == \
+                [s for s in index.leafnames if s in species]
+        node = gtree.get_child_at(1).get_child_at(1)
+        assert node.is_monophyletic(['a', 'b', 'c', 'g'])
+        assert not node.is_monophyletic(['a', 'b'])
+        # a,b,c,d,f under both children of the root
+        self.assertAlmostEqual(gtree.compute_dup_cons(), 1)
+        # the bitsets are neither written nor copied
+        assert 'spbits' not in gtree.write(features=[])
+        assert gtree.copy("cpickle").get_species_bits() is None
+        # and are cleared on the path to the root when the tree is changed
+        leaf = node.get_leaves()[0]
+        leaf.detach()
+        assert node.get_species_bits() is None
+        assert gtree.get_species_bits() is None
+        assert leaf.get_species_bits() is not None
+        assert gtree.get_child_at(0).get_species_bits() is not None
+        assert not node.is_monophyletic(['a', 'b'])
+        # nothing is set when a species is missing from the index
+        gtree = TreeClass("((a_1,c_1),(a_2,x_1));")
+        gtree.set_species(pos="prefix")
+        self.assertRaises(ValueError, gtree.set_species_bits, index)
+        assert all(n.get_species_bits() is None for n in gtree.traverse())
+
+    def test_image_tree(self):
+        stree = TreeClass("(((a,b)e,c)f,(d,g)i)h;", format=1)
+        gtree = TreeClass("((d_1,b_1,a_1),(c_1,b_2));")
+        gtree.set_species(pos="prefix")
+        lcamap = lcaMapping(gtree, stree)
+        polytomy = gtree.get_child_at(0)
+        ids, parent = getImageTreeArrays(gtree, stree, lcamap)[polytomy]
+        assert [stree.id2node[i].name for i in ids] == list('heabd')
+        assert parent.tolist() == [-1, 0, 1, 1, 0]
+        images = getImageTreeNode(gtree, stree, lcamap)
+        assert images[polytomy].write(format=8, format_root_node=True) == "(d,(b,a)e)h;"
+        assert images[gtree].write(format=8, format_root_node=True) == "(f)h;"
+        # the children are sorted by the postorder of their images
+        assert [c.species for c in polytomy.children] == list('abd')
@@ -9,6 +9,7 @@ from ..TreeLib.TreeUtils import *
 from ..TreeLib import params
 from ..PolytomySolver.Multipolysolver import polytomyPreprocess, polySolver
 from ..PolytomySolver.Multipolysolver import solvePolytomy, computePolytomyReconCost
+from ..PolytomySolver.Multipolysolver import computePolytomyReconCostSweep
 from ..PolytomySolver import *
 from ..tests import dirname
 
@@ -87,6 +88,23 @@ class TestSolver(unittest.TestCase):
             TreeClass("(((a_2, b_3), ((b_1,b_2), a_1)), c_1);"))[0]
         assert rf == 0
 
+    def test_polysolver_cost_model(self):
+        dup_cost = {}
+        loss_cost = {}
+        for node in self.sptreestar:
+            if node.name == 'd':
+                loss_cost[params.get_hash(node.name)] = 1.5
+            if node.name in ['a', 'b']:
+                dup_cost[params.get_hash(node.name)] = 0.5
+        costs = params.CostModel(dup_cost, loss_cost, internal_mode='mean')
+        # same table as test_polysolver_star, without changing params
+        matrix, row_node = polySolver(treeHash(self.star, addinfos=costs.key),
+                                      self.star, self.sptreestar, None, [], 1,
+                                      verbose=False, mode="none", costs=costs)
+        for key in row_node:
+            assert np.array_equal(matrix[key, :], self.matrix[
+                                  row_node[key].name])
+
     def test_polysolver_no_star(self):
         dup_cost = {}
         loss_cost = {}
@@ -119,6 +137,59 @@ class TestSolver(unittest.TestCase):
         self.assertEqual(
             dup + loss, computePolytomyReconCost(self.nostar, self.sptreestar))
 
+    def test_recon_cost_species(self):
+        # per species costs : a loss is charged the cost of the lost specie
+        gtree = TreeClass("((a_1,c_1),(a_2,b_1,d_1),(c_2,b_2));")
+        gtree.set_species(pos="prefix")
+        dup_cost = {params.get_hash(['a']): 0.5, params.get_hash(['d']): 2}
+        loss_cost = {params.get_hash(['a']): 3, params.get_hash(['b']): 0.5,
+                     params.get_hash(['d']): 2}
+        costs = params.CostModel(dup_cost, loss_cost)
+        recon_cost = computePolytomyReconCost(
+            gtree.copy(), self.sptreestar, costs=costs)
+        node_order = gtree.get_leaf_names()
+        dist_mat = C.makeFakeDstMatrice(len(node_order), 1, 10)
+        solutions = solvePolytomy(gtree, self.sptreestar, dist_mat, node_order,
+                                  sol_limit=5, path_limit=5, costs=costs)
+        assert solutions
+        for tree in solutions:
+            lcaMapping(tree, self.sptreestar, multspeciename=False)
+            self.assertAlmostEqual(sum(computeDLScore(tree, costs=costs)),
+                                   recon_cost)
+
+    def test_recon_cost_sweep(self):
+        self.gtree.set_species(pos="prefix")
+        self.stree.label_internal_node()
+        costs_list = [params.CostModel(constdlcost=dl)
+                      for dl in [(1, 1), (2, 1), (1, 2), (3, 0.5)]]
+        sweep = computePolytomyReconCostSweep(
+            self.gtree, self.stree, costs_list)
+        assert sweep[0] == 15
+        for costs, cost in zip(costs_list, sweep):
+            self.assertAlmostEqual(cost, computePolytomyReconCost(
+                self.gtree.copy(), self.stree, costs=costs))
+
+    def test_recon_cost_sweep_species(self):
+        self.gtree.set_species(pos="prefix")
+        self.stree.label_internal_node()
+        dup = {params.get_hash(['scer']): 2, params.get_hash(['calb']): 1.5}
+        loss = {params.get_hash(['scer']): 0.5, params.get_hash(['cgla']): 3,
+                params.get_hash(['lelo']): 2}
+        costs_list = [params.CostModel(dup, loss, dl)
+                      for dl in [(1, 1), (2, 1), (1, 2), (3, 0.5)]]
+        sweep = computePolytomyReconCostSweep(
+            self.gtree, self.stree, costs_list)
+        node_order = self.gtree.get_leaf_names()
+        dist_mat = C.makeFakeDstMatrice(len(node_order), 1, 10)
+        # each cost is the score of a tree corrected with the same costs
+        for costs, cost in zip(costs_list, sweep):
+            tree = solvePolytomy(self.gtree.copy(), self.stree, dist_mat,
+                                 node_order, sol_limit=1, path_limit=1,
+                                 costs=costs)[0]
+            lcaMapping(tree, self.stree, multspeciename=False)
+            self.assertAlmostEqual(
+                cost, sum(computeDLScore(tree, costs=costs)))
+
     def test_solvepolytomy(self):
         self.gtree.set_species(pos="prefix")
         self.stree.label_internal_node()
@@ -176,6 +247,23 @@ class TestSolver(unittest.TestCase):
         solver = SingleSolver.Dynamiq2(genetree, specietree, lcamap)
         self.solvePolytomies(solver)
 
+    def test_zheng_image_tree(self):
+        stree = TreeClass("(((a,b)e,c)f,(d,g)i)h;", format=1)
+        gtree = TreeClass("((d_1,b_1,a_1),(c_1,b_2));")
+        gtree.set_species(pos="prefix")
+        polytomy = gtree.get_child_at(0)
+        lcamap = lcaMapping(gtree, stree, False)
+        solver = SingleSolver.LinPolySolver(gtree, stree, lcamap)
+        [(node, image)] = solver._image_trees()
+        assert node is polytomy
+        assert image.names == list('heabd') and image.depth == [0, 2, 3, 3, 2]
+        # same children order as getImageTreeNode : (d,(b,a)e)h
+        assert [image.names[pos] for pos in image.postorder()] == list('dbaeh')
+        W, rW = solver._image_mult(polytomy, image)
+        assert W == [0, 0, 1, 1, 1]
+        assert [g.species for genes in rW for g in genes] == list('abd')
+        assert solver.reconstruct() == "((b_2,c_1),(d_1,(b_1,a_1)));"
+
     def solvePolytomies(self, solver, solver_type='defsolver'):
 
         sols = []
@@ -191,3 +279,150 @@ class TestSolver(unittest.TestCase):
         lcamap = lcaMapping(t, specietree, False)
         dup, loss = computeDL(t, lcamap)
         self.assertAlmostEqual((dup + loss) / 7605, 1)
+
+    def test_memorize_lru(self):
+        from ..TreeLib import memorize
+        calls = []
+
+        @memorize
+        def square(x):
+            calls.append(x)
+            return [x] * x
+
+        square.maxsize = 2
+        for x in (2, 3, 2, 4, 3, 2):
+            assert square(x, x) == [x] * x
+        # 3 is evicted by 4, then 2 by 3
+        assert calls == [2, 3, 4, 3, 2]
+        stats = square.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions'],
+                stats['size']) == (1, 5, 3, 2)
+        assert memorize.all_stats()['square'] == stats
+        assert square(None, 5) == [5] * 5 and square.stats()['size'] == 2
+        # the outputs are only sized with a bound in bytes
+        assert stats['bytes'] == 0
+        square.maxsize, square.maxbytes = None, 1
+        square(5, 5)
+        assert list(square.cache) == [5] and square.nbytes > 0
+
+    def test_memorize_cachedir(self):
+        import shutil
+        import tempfile
+        from ..TreeLib import memorize
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return [x] * x
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cached = memorize(square)
+            cached.cachedir = tmpdir
+            assert cached('k3', 3) == [3] * 3
+            # a new process reads the output saved by the first one
+            cached = memorize(square)
+            cached.cachedir = tmpdir
+            assert cached('k3', 3) == [3] * 3 and calls == [3]
+            assert cached.stats()['diskhits'] == 1
+            # a file that doesn't match its hash is not used
+            cachefile = cached.cachefile('k3')
+            shutil.copy(cachefile, cached.cachefile('k4'))
+            with open(cachefile, 'r+b') as damaged:
+                damaged.seek(-2, os.SEEK_END)
+                damaged.write('XX')
+            cached = memorize(square)
+            cached.cachedir = tmpdir
+            assert cached('k4', 4) == [4] * 4 and cached('k3', 3) == [3] * 3
+            assert calls == [3, 4, 3] and cached.stats()['diskhits'] == 0
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_find_max_x_leaf(self):
+        from ..PolytomySolver.Multipolysolver import findMaxX
+        gtree = TreeClass("(a_1,a_2,a_3);")
+        gtree.set_species(pos="prefix")
+        lcaMapping(gtree, self.sptreestar)
+        names, rows = findMaxX(gtree, self.sptreestar.copy())
+        assert names == set(['a']) and [n.name for n in rows.values()] == ['a']
+
+    def test_sweep_cost_row(self):
+        from ..PolytomySolver.Multipolysolver import sweepCostRow, SPEC, DUP, LOST
+        row = np.array([np.inf, 4, 2, 3, 6, 5])
+        flags = np.array([0] + [SPEC] * 5, dtype=np.uint8)
+        # loss cost of 1 on the right of the minimum, dup cost of 2 on the left
+        sweepCostRow(row[2:], flags[2:], 1, LOST)
+        sweepCostRow(row[2::-1], flags[2::-1], 2, DUP)
+        assert row.tolist() == [6, 4, 2, 3, 4, 5]
+        assert flags.tolist() == [DUP, SPEC | DUP, SPEC, SPEC | LOST,
+                                  LOST, SPEC | LOST]
+        # fractional costs, rounded as the loop over the cells of the row
+        rand = np.random.RandomState(3)
+        for cost in [0.1, 0.3, 0.7]:
+            row = np.round(rand.rand(30) * 3, 1)
+            flags = np.full(30, SPEC, dtype=np.uint8)
+            expected, expected_flags = row.tolist(), flags.tolist()
+            for i in range(1, 30):
+                if expected[i] == expected[i - 1] + cost:
+                    expected_flags[i] |= LOST
+                elif expected[i] > expected[i - 1] + cost:
+                    expected[i] = expected[i - 1] + cost
+                    expected_flags[i] = LOST
+            sweepCostRow(row, flags, cost, LOST)
+            assert row.tolist() == expected
+            assert flags.tolist() == expected_flags
+
+    def test_iter_path_from_table(self):
+        from ..PolytomySolver.Multipolysolver import findMaxX, fillCostTable
+        from ..PolytomySolver.Multipolysolver import findPathFromTable, iterPathFromTable, rowIds
+        gtree = TreeClass("(a_1,a_2,a_3,b_1,b_2,b_3,d_1,d_2,d_3);")
+        gtree.set_species(pos="prefix")
+        lcaMapping(gtree, self.sptreestar, multspeciename=False)
+        sptree = self.sptreestar.copy()
+        count = getSpecieCount(gtree)
+        species, rows = findMaxX(gtree, sptree)
+        cost_table, path_table = fillCostTable(
+            sptree, rows, count, max(count.values()) + 1)
+        # paths of the table of strings, before the flags
+        expected = ['g:1,e:1,c:1,c:0,d:1,d:2,d:3,f:1,f:2,f:3,a:3,b:3',
+                    'g:1,g:2,e:2,c:2,c:1,c:0,d:2,d:3,f:2,f:3,a:3,b:3',
+                    'g:1,g:2,g:3,e:3,c:3,c:2,c:1,c:0,d:3,f:3,a:3,b:3']
+        paths = findPathFromTable(path_table, rows, count, len(rows) - 1, 0)
+        assert paths == expected
+        lazy = iterPathFromTable(path_table, rows, count, len(rows) - 1, 0)
+        assert next(lazy) == expected[0] and list(lazy) == expected[1:]
+        # the rows of the specie nodes can be built once by the caller
+        assert findPathFromTable(path_table, rows, count, len(rows) - 1, 0,
+                                 rowIds(rows)) == expected
+
+    def test_polysolver_limit(self):
+        from ..PolytomySolver import Multipolysolver
+        gtree = TreeClass("(a_1,a_2,a_3,b_1,b_2,b_3,d_1,d_2,d_3);")
+        gtree.set_species(pos="prefix")
+        lcaMapping(gtree, self.sptreestar, multspeciename=False)
+        node_order = gtree.get_leaf_names()
+        dist_mat = C.makeFakeDstMatrice(len(node_order), 1, 10)
+        iter_paths = Multipolysolver.iterPathFromTable
+        built = []
+
+        def counted_paths(path_table, rows, count, xpos, ypos, *args):
+            paths = iter_paths(path_table, rows, count, xpos, ypos, *args)
+            for path in paths:
+                # only the paths of the root cell, not the partial ones
+                if (xpos, ypos) == (len(rows) - 1, 0):
+                    built.append(path)
+                yield path
+        Multipolysolver.iterPathFromTable = counted_paths
+        try:
+            solutions = polySolver(None, gtree, self.sptreestar, dist_mat,
+                                   node_order, -1)
+            assert len(solutions) == len(built) == 3
+            del built[:]
+            # the paths after the limit are never built
+            first = polySolver(None, gtree, self.sptreestar, dist_mat,
+                               node_order, 2)
+            assert len(first) == len(built) == 2
+        finally:
+            Multipolysolver.iterPathFromTable = iter_paths
+        assert [t.write(format=9) for t in first] == \
+            [t.write(format=9) for t in solutions[:2]]
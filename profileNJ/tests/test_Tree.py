@@ -92,3 +92,25 @@ class TestTreeClass(unittest.TestCase):
                 rf = edge_reroot[i].robinson_foulds(
                     edge_reroot[j], unrooted_trees=True)[0]
                 assert rf == 0
+
+    def test_structural_hash(self):
+        tree = TreeClass("((c,(b,a))f,d)h;", format=1)
+        # the order of the children and the internal names don't matter
+        assert tree.structural_hash() == self.tree2.structural_hash()
+        assert (tree & 'f').structural_hash() == \
+            TreeClass("(c,(a,b));").structural_hash()
+        assert tree.structural_hash() != TreeClass("((c,a,b),d);").structural_hash()
+        assert tree.structural_hash() != TreeClass("((a,(b,c)),d);").structural_hash()
+        # the hashes are cleared when the tree is changed
+        old = tree.structural_hash()
+        (tree & 'd').name = 'g'
+        assert tree.structural_hash() == TreeClass(
+            "((c,(b,a)),g);").structural_hash()
+        tree.add_child(name='d')
+        (tree & 'g').detach()
+        assert tree.structural_hash() == old
+        (tree & 'a').detach()
+        assert tree.structural_hash() != old
+        (tree & 'f').detach()
+        tree.add_child(self.tree2.get_child_at(0).copy())
+        assert tree.structural_hash() == old